@@ -0,0 +1,350 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_CONCURRENCY = "1,2,4"
+DEFAULT_THREAD_LIMITS = "1,2"
+DEFAULT_ITERATIONS = 3
+DEFAULT_MAX_REGRESSION = 0.10
+RESULT_SCHEMA_VERSION = 1
+
+TOOL_BINARIES = {
+    "magick": "/usr/local/bin/magick",
+    "gs": "/usr/local/bin/gs",
+    "ffmpeg": "/usr/local/bin/ffmpeg",
+    "pngquant": "/usr/local/bin/pngquant",
+    "exiftool": "exiftool",
+}
+TOOL_VERSION_ARGS = {
+    "magick": ["-version"],
+    "gs": ["-version"],
+    "ffmpeg": ["-version"],
+    "pngquant": ["--version"],
+    "exiftool": ["-ver"],
+}
+
+# Synthetic fixtures; all are generated locally so the benchmark runs offline.
+FIXTURES = {
+    "tiff": ("magick", lambda tools, path: [
+        tools["magick"], "-seed", "1", "-size", "6000x4000", "plasma:fractal",
+        "-depth", "16", "-compress", "none", path,
+    ], "fixture.tif"),
+    "jpeg": ("magick", lambda tools, path: [
+        tools["magick"], "-size", "6000x4000", "-seed", "2", "plasma:", "-quality", "92", path,
+    ], "fixture.jpg"),
+    "png": ("magick", lambda tools, path: [
+        tools["magick"], "-size", "3000x2000", "-seed", "3", "plasma:", path,
+    ], "fixture.png"),
+    "pdf": ("magick", lambda tools, path: [
+        tools["magick"], "-size", "2480x3508", "-seed", "4", "plasma:", "-seed", "5", "plasma:",
+        "-seed", "6", "plasma:", "-seed", "7", "plasma:", "-density", "300", "-compress", "jpeg", path,
+    ], "fixture.pdf"),
+    "video": ("ffmpeg", lambda tools, path: [
+        tools["ffmpeg"], "-loglevel", "error", "-y", "-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=25",
+        "-t", "5", "-pix_fmt", "yuv420p", "-c:v", "libx264", "-preset", "ultrafast", path,
+    ], "fixture.mp4"),
+}
+
+# Representative operations of the Service-Client facilities.
+WORKLOADS = {
+    "magick_resize_jpeg": ("magick", "jpeg", lambda tools, src, out: [
+        tools["magick"], src, "-resize", "25%", "-quality", "85", out + ".jpg",
+    ]),
+    "magick_tiff_to_jpeg_thumbnail": ("magick", "tiff", lambda tools, src, out: [
+        tools["magick"], src, "-thumbnail", "1024x1024", "-colorspace", "sRGB", out + ".jpg",
+    ]),
+    "gs_rasterize_pdf": ("gs", "pdf", lambda tools, src, out: [
+        tools["gs"], "-q", "-dBATCH", "-dNOPAUSE", "-dSAFER", "-sDEVICE=png16m", "-r150",
+        f"-sOutputFile={out}-%d.png", src,
+    ]),
+    "ffmpeg_transcode_h264": ("ffmpeg", "video", lambda tools, src, out: [
+        tools["ffmpeg"], "-loglevel", "error", "-y", "-i", src, "-vf", "scale=1280:-2",
+        "-c:v", "libx264", "-preset", "veryfast", out + ".mp4",
+    ]),
+    "pngquant_quantize": ("pngquant", "png", lambda tools, src, out: [
+        tools["pngquant"], "--force", "--output", out + ".png", "256", src,
+    ]),
+    "exiftool_read_metadata": ("exiftool", "jpeg", lambda tools, src, out: [
+        tools["exiftool"], "-j", "-G", src,
+    ]),
+}
+
+def _parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def resolve_tools(binaries=None):
+    """
+    Locate the benchmarked tools. Returns a dict mapping each tool name to its
+    executable path, leaving out tools that are not installed.
+    """
+    tools = {}
+    for name, binary in (binaries or TOOL_BINARIES).items():
+        path = binary if os.path.isabs(binary) and os.access(binary, os.X_OK) else shutil.which(binary)
+        if path:
+            tools[name] = path
+    return tools
+
+def tool_versions(tools):
+    versions = {}
+    for name, path in tools.items():
+        try:
+            result = subprocess.run(
+                [path] + TOOL_VERSION_ARGS.get(name, ["--version"]),
+                capture_output=True, text=True, timeout=30,
+            )
+            output = (result.stdout or result.stderr).strip()
+            versions[name] = output.splitlines()[0] if output else ""
+        except (OSError, subprocess.SubprocessError) as exc:
+            versions[name] = f"unknown ({exc})"
+    return versions
+
+def run_timed(command, env=None, timeout=None):
+    """
+    Run a command and measure it.
+
+    Returns:
+    Dict: Wall time, user/system CPU time and peak RSS (KiB) of the child,
+    and its exit status.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        killer = threading.Timer(timeout, process.kill) if timeout else None
+        if killer:
+            killer.start()
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            if killer:
+                killer.cancel()
+        elapsed = time.perf_counter() - start
+        # wait4 reaped the child; keep Popen from waiting on it again.
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode('utf-8', errors='replace').strip()
+    return {
+        "seconds": elapsed,
+        "user_seconds": rusage.ru_utime,
+        "system_seconds": rusage.ru_stime,
+        "max_rss_kib": rusage.ru_maxrss,
+        "returncode": process.returncode,
+        "stderr": stderr[-500:],
+    }
+
+def generate_fixtures(tools, workdir, names=None):
+    """
+    Create the synthetic input files with the installed tools.
+    Returns a dict mapping fixture names to paths; fixtures whose tool is
+    missing or fails are left out.
+    """
+    fixtures = {}
+    for name, (tool, build, filename) in FIXTURES.items():
+        if names is not None and name not in names:
+            continue
+        if tool not in tools:
+            print(f"Skipping fixture {name}: {tool} not available.", file=sys.stderr)
+            continue
+        path = os.path.join(workdir, filename)
+        if not os.path.exists(path):
+            result = run_timed(build(tools, path))
+            if result["returncode"] != 0:
+                print(f"Warning: Unable to generate fixture {name}: {result['stderr']}", file=sys.stderr)
+                continue
+        fixtures[name] = path
+    return fixtures
+
+def summarize(durations, wall_seconds):
+    ordered = sorted(durations)
+    p95_index = max(0, int(round(0.95 * len(ordered))) - 1)
+    return {
+        "operations": len(ordered),
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_per_second": round(len(ordered) / wall_seconds, 4) if wall_seconds > 0 else None,
+        "mean_seconds": round(statistics.mean(ordered), 4),
+        "p50_seconds": round(statistics.median(ordered), 4),
+        "p95_seconds": round(ordered[p95_index], 4),
+    }
+
+def run_workload(command_factory, concurrency, iterations, env, workdir):
+    """
+    Run iterations * concurrency invocations of a workload with the given
+    number in flight at once.
+
+    Returns:
+    Dict: Summary statistics (see summarize), peak RSS and CPU time, or an
+    "error" entry when an invocation failed.
+    """
+    total = max(1, iterations) * max(1, concurrency)
+
+    def invoke(index):
+        return run_timed(command_factory(os.path.join(workdir, f"out-{index}")), env=env)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        runs = list(pool.map(invoke, range(total)))
+    wall_seconds = time.perf_counter() - start
+
+    failures = [run for run in runs if run["returncode"] != 0]
+    if failures:
+        return {"error": failures[0]["stderr"] or f"exit code {failures[0]['returncode']}"}
+    result = summarize([run["seconds"] for run in runs], wall_seconds)
+    result["max_rss_kib"] = max(run["max_rss_kib"] for run in runs)
+    result["cpu_seconds"] = round(sum(run["user_seconds"] + run["system_seconds"] for run in runs), 4)
+    return result
+
+def policy_settings(thread_limits, memory_limits):
+    """
+    Cross product of ImageMagick thread and memory limits to benchmark.
+    None keeps the image's policy.xml default.
+    """
+    return [
+        {"thread": threads, "memory": memory}
+        for threads in (thread_limits or [None])
+        for memory in (memory_limits or [None])
+    ]
+
+def policy_environment(policy, base_env=None):
+    env = dict(os.environ if base_env is None else base_env)
+    if policy.get("thread") is not None:
+        env.update(MAGICK_THREAD_LIMIT=str(policy["thread"]), OMP_NUM_THREADS=str(policy["thread"]))
+    if policy.get("memory") is not None:
+        env["MAGICK_MEMORY_LIMIT"] = str(policy["memory"])
+    if policy.get("map") is not None:
+        env["MAGICK_MAP_LIMIT"] = str(policy["map"])
+    return env
+
+def run_benchmarks(tools, fixtures, workloads, concurrency_levels, policies, iterations, workdir):
+    results = []
+    for name, (tool, fixture, build) in workloads.items():
+        if tool not in tools or fixture not in fixtures:
+            results.append({"workload": name, "skipped": f"{tool} or {fixture} fixture not available"})
+            continue
+        # Policy settings only apply to ImageMagick.
+        for policy in (policies if tool == "magick" else [{}]):
+            env = policy_environment(policy)
+            for concurrency in concurrency_levels:
+                out_dir = tempfile.mkdtemp(prefix=f"{name}-", dir=workdir)
+                try:
+                    measurement = run_workload(
+                        lambda out: build(tools, fixtures[fixture], out), concurrency, iterations, env, out_dir
+                    )
+                finally:
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                entry = {"workload": name, "tool": tool, "concurrency": concurrency, "policy": policy}
+                entry.update(measurement)
+                results.append(entry)
+                print(f"{name} c={concurrency} policy={json.dumps(policy)}: {json.dumps(measurement)}",
+                      file=sys.stderr)
+    return results
+
+def _result_key(entry):
+    return entry.get("workload"), entry.get("concurrency"), json.dumps(entry.get("policy"), sort_keys=True)
+
+def compare_results(results, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """
+    Compare throughput against a previous run.
+
+    Returns:
+    List[Dict]: Workloads whose throughput dropped by more than max_regression.
+    """
+    previous = {_result_key(entry): entry for entry in baseline.get("results", [])}
+    regressions = []
+    for entry in results:
+        old = previous.get(_result_key(entry))
+        if not old or not old.get("throughput_per_second") or not entry.get("throughput_per_second"):
+            continue
+        change = entry["throughput_per_second"] / old["throughput_per_second"] - 1
+        if change < -max_regression:
+            regressions.append({
+                "workload": entry["workload"],
+                "concurrency": entry["concurrency"],
+                "policy": entry["policy"],
+                "baseline_throughput": old["throughput_per_second"],
+                "throughput": entry["throughput_per_second"],
+                "change": round(change, 4),
+            })
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the media tools bundled in this image.")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--workdir", help="Directory for fixtures and outputs (default: a temporary directory).")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY,
+                        help=f"Comma-separated concurrency levels (default {DEFAULT_CONCURRENCY}).")
+    parser.add_argument("--thread-limits", default=DEFAULT_THREAD_LIMITS,
+                        help=f"Comma-separated ImageMagick/OpenMP thread limits (default {DEFAULT_THREAD_LIMITS}).")
+    parser.add_argument("--memory-limits", default="",
+                        help="Comma-separated ImageMagick memory limits, e.g. 256MiB,1GiB (default: policy.xml).")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help=f"Invocations per concurrency slot (default {DEFAULT_ITERATIONS}).")
+    parser.add_argument("--workloads", help="Comma-separated subset of: " + ", ".join(WORKLOADS))
+    parser.add_argument("--baseline", help="Previous JSON results to compare throughput against.")
+    parser.add_argument("--max-regression", type=float, default=DEFAULT_MAX_REGRESSION,
+                        help="Tolerated throughput drop against the baseline (default 0.10).")
+    args = parser.parse_args(argv)
+
+    workloads = WORKLOADS
+    if args.workloads:
+        selected = [name.strip() for name in args.workloads.split(',') if name.strip()]
+        unknown = [name for name in selected if name not in WORKLOADS]
+        if unknown:
+            parser.error(f"Unknown workloads: {', '.join(unknown)}")
+        workloads = {name: WORKLOADS[name] for name in selected}
+
+    tools = resolve_tools()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cs-image-tools-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        fixtures = generate_fixtures(tools, workdir, {fixture for _, fixture, _ in workloads.values()})
+        results = run_benchmarks(
+            tools, fixtures, workloads, _parse_int_list(args.concurrency),
+            policy_settings(_parse_int_list(args.thread_limits),
+                            [item.strip() for item in args.memory_limits.split(',') if item.strip()]),
+            args.iterations, workdir,
+        )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "schema_version": RESULT_SCHEMA_VERSION,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": {
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "available_cpus": len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+        },
+        "tools": tool_versions(tools),
+        "iterations": args.iterations,
+        "results": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as handle:
+            report["regressions"] = compare_results(results, json.load(handle), args.max_regression)
+        for regression in report["regressions"]:
+            print(f"Regression: {json.dumps(regression)}", file=sys.stderr)
+        status = 1 if report["regressions"] else 0
+
+    rendered = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            handle.write(rendered + "\n")
+        print(f"Benchmark results written to {args.output}", file=sys.stderr)
+    else:
+        print(rendered)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import json
+import os
+import re
+import socket
+import struct
+import sys
+
+EXIFTOOL_BINARY = "/usr/local/bin/exiftool"
+DEFAULT_EXIFTOOL_SOCKET_PATH = "/tmp/cs-image-tools-exiftool.sock"
+DEFAULT_EXIFTOOL_DAEMON_TIMEOUT = 120
+FRAME_HEADER = struct.Struct('>I')
+# Options that only work on a real command line, or that need the client's stdin.
+DIRECT_ONLY_OPTIONS = {'-stay_open', '-@', '-config', '-', '-k', '-pause'}
+# Options whose value names a file, which may not exist yet.
+PATH_VALUE_OPTIONS = {'-o', '-out', '-tagsfromfile', '-srcfile'}
+# Options whose "=FILE" form imports a file; other "-NAME=VALUE" arguments
+# are tag assignments and stay untouched.
+PATH_ASSIGNMENT_OPTIONS = {'-csv', '-json'}
+# Options whose value is not a file name, even when a file of that name exists.
+TEXT_VALUE_OPTIONS = re.compile(
+    r'^-(?:api|c|coordformat|charset|d|dateformat|echo\d?|ext\+?|extension\+?|fileorder\d?|'
+    r'globaltimeshift|i|ignore|if\d?|lang|listitem|password|sep|separator|userparam|'
+    r'w!?\+?|textout!?\+?|tagout!?\+?|x|exclude)$',
+    re.IGNORECASE,
+)
+
+def send_frame(sock, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("exiftool daemon closed the connection")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def recv_frame(sock):
+    (size,) = FRAME_HEADER.unpack(_recv_exact(sock, FRAME_HEADER.size))
+    return _recv_exact(sock, size)
+
+def _absolute(value, cwd):
+    # "@" is the source file itself, "-" is stdout and a leading "%" is a
+    # format code relative to the source file's directory.
+    if os.path.isabs(value) or value in ('@', '-') or value.startswith('%'):
+        return value
+    return os.path.join(cwd, value)
+
+def daemon_args(args, cwd):
+    """
+    Prepares arguments for the daemon's exiftool processes, which run in a
+    different working directory. Relative file operands, the values of path
+    options and "-TAG<=FILE" sources become absolute; tag assignments are
+    never rewritten.
+
+    Returns:
+    List[str]: The arguments, or None when the call must run exiftool directly
+    (options that only work on a real command line, stdin input, or values the
+    line-based argument protocol cannot carry).
+    """
+    resolved = []
+    for index, arg in enumerate(args):
+        if arg.lower() in DIRECT_ONLY_OPTIONS or '\n' in arg or arg.startswith('#') or arg != arg.strip():
+            return None
+        previous = args[index - 1] if index else ''
+        if previous.lower() in PATH_VALUE_OPTIONS:
+            arg = _absolute(arg, cwd)
+        elif TEXT_VALUE_OPTIONS.match(previous):
+            pass
+        elif not arg.startswith('-'):
+            if os.path.exists(os.path.join(cwd, arg)):
+                arg = _absolute(arg, cwd)
+        else:
+            option, separator, value = arg.partition('=')
+            if separator and option.endswith('<') and os.path.exists(os.path.join(cwd, value)):
+                arg = f"{option}={_absolute(value, cwd)}"
+            elif separator and value and option.lower() in PATH_ASSIGNMENT_OPTIONS:
+                arg = f"{option}={_absolute(value, cwd)}"
+        resolved.append(arg)
+    return resolved
+
+def run_via_daemon(args, socket_path, timeout):
+    """
+    Sends one exiftool invocation to the daemon and relays its output.
+
+    Returns:
+    int: The exit code, or None when the daemon is not reachable and nothing
+    was sent, so the caller can still run exiftool directly.
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+    except OSError:
+        return None
+    with sock:
+        try:
+            send_frame(sock, json.dumps({"args": args}).encode('utf-8'))
+        except OSError:
+            return None
+        try:
+            response = json.loads(recv_frame(sock).decode('utf-8'))
+            stdout = recv_frame(sock)
+            stderr = recv_frame(sock)
+        except (OSError, ValueError) as exc:
+            print(f"Error: exiftool daemon failed: {exc}", file=sys.stderr)
+            return 1
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.buffer.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.buffer.flush()
+    return int(response.get("returncode", 1))
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    args = daemon_args(argv[1:], os.getcwd())
+    if args is not None:
+        timeout = os.getenv('EXIFTOOL_DAEMON_TIMEOUT', '')
+        timeout = int(timeout) if timeout.isdigit() else DEFAULT_EXIFTOOL_DAEMON_TIMEOUT
+        socket_path = os.getenv('EXIFTOOL_DAEMON_SOCKET', DEFAULT_EXIFTOOL_SOCKET_PATH)
+        # Leave the daemon time to answer with its own timeout error first.
+        returncode = run_via_daemon(args, socket_path, timeout + 5)
+        if returncode is not None:
+            return returncode
+    os.execv(EXIFTOOL_BINARY, [EXIFTOOL_BINARY] + argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,999 @@
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import secrets
+import struct
+import math
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+DEFAULT_RENDITION_CACHE_MAX_BYTES = 10 * 1024 ** 3
+CACHE_FORMAT_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MEMO_MAX_AGE = 7 * 24 * 3600
+HASH_MEMO_SWEEP_INTERVAL = 24 * 3600
+# Eviction frees space down to this share of the cap, so a full cache is not
+# walked again on the next store.
+EVICTION_TARGET_RATIO = 0.9
+FICLONE = 0x40049409
+FORMAT_PREFIX_PATTERN = re.compile(r'^([A-Za-z0-9]{2,10}):(.+)$')
+FRAME_SUFFIX_PATTERN = re.compile(r'^(.+)\[[^\]]*\]$')
+# printf-style frame numbers such as "frame-%03d.png".
+FRAME_NUMBER_PATTERN = re.compile(r'%0?\d*d')
+DEFAULT_INSTRUMENTATION_MAX_BYTES = 50 * 1024 ** 2
+DEFAULT_INSTRUMENTATION_BACKUPS = 3
+FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+PR_SET_PDEATHSIG = 1
+REDACTED = "***"
+URL_CREDENTIALS_PATTERN = re.compile(r'(://)[^/@\s]+@')
+SECRET_ASSIGNMENT_PATTERN = re.compile(r'(?i)((?:password|passwd|pwd|token|secret|apikey|api_key)[^=]*=)[^\s&]+')
+SECRET_OPTION_PATTERN = re.compile(r'(?i)^-{1,2}\w*(?:password|passwd|token|secret)$')
+DEFAULT_ADMISSION_SLOT_BYTES = 256 * 1024 ** 2
+DEFAULT_ADMISSION_TIMEOUT = 600
+DEFAULT_ADMISSION_BYTES_PER_PIXEL = 16
+DEFAULT_ADMISSION_WEIGHTS = "magick=2,gs=2,ffmpeg=2,wkhtmltoimage=2,pngquant=1,exiftool=0"
+ADMISSION_TIMEOUT_EXIT_CODE = 75
+# Letter-sized page in inches, for Ghostscript runs that only give a resolution.
+GS_DEFAULT_PAGE_INCHES = (8.5, 11)
+DEFAULT_GS_PREVIEW_MAX_RESOLUTION = 150
+# Ghostscript's resolution when a raster device is used without -r.
+GS_DEFAULT_RESOLUTION = 72
+GS_RASTER_DEVICE_PATTERN = re.compile(r'^(?:png|jpeg|tiff|bmp|pnm|ppm|pgm|pbm|pkm|psd|bit|ink)')
+# ffmpeg options that take no value, so a file name may follow them.
+FFMPEG_FLAG_OPTIONS = {
+    '-y', '-n', '-an', '-vn', '-sn', '-dn', '-nostdin', '-hide_banner', '-stats', '-nostats',
+    '-shortest', '-re', '-copyts', '-start_at_zero', '-accurate_seek', '-noaccurate_seek', '-benchmark',
+}
+FFMPEG_VIDEO_CODEC_OPTIONS = ('-c:v', '-codec:v', '-vcodec', '-c', '-codec')
+EXIFTOOL_WRITE_OPTIONS = {
+    '-o', '-out', '-w', '-overwrite_original', '-overwrite_original_in_place', '-tagsfromfile',
+    '-geotag', '-delete_original', '-delete_original!', '-restore_original', '-@', '-stay_open',
+}
+
+def _parse_size(value, default):
+    match = re.fullmatch(r'\s*(\d+)\s*([KMGT]?)(?:i?B)?\s*', str(value or ''), re.IGNORECASE)
+    if not match:
+        return default
+    return int(match.group(1)) * (1024 ** " KMGT".index(match.group(2).upper() or " "))
+
+def _parse_int(value, default):
+    value = str(value or '').strip()
+    return int(value) if value.isdigit() else default
+
+def tool_kind(binary):
+    name = os.path.basename(binary)
+    if name in ('magick', 'convert', 'composite', 'montage', 'identify'):
+        return 'magick'
+    if name in ('gs', 'gsc', 'gsx'):
+        return 'gs'
+    return name
+
+def _strip_format_prefix(arg):
+    match = FORMAT_PREFIX_PATTERN.match(arg)
+    return match.group(2) if match and not arg.startswith(('/', '.')) else arg
+
+def rendition_outputs(binary, args):
+    """
+    Works out which arguments name the output files of a tool invocation.
+
+    Returns:
+    List[Tuple[int, str]]: (argument index, option prefix) per output file; an
+    empty list for read-only calls whose result is stdout; None when the call
+    cannot be cached safely (in-place edits, pipes, numbered or multiple outputs,
+    or inputs the key cannot hash, such as @lists, globs and HTML pages).
+    """
+    kind = tool_kind(binary)
+    if not args or any('://' in arg or _is_indirect_input(arg) for arg in args):
+        return None
+    if kind == 'magick':
+        if any(arg in ('-write', '+write') for arg in args):
+            return None
+        if os.path.basename(binary) == 'identify' or args[0] == 'identify':
+            return []
+        if len(args) < 2 or args[-1].startswith('-') or args[-1] == '-' or FRAME_NUMBER_PATTERN.search(args[-1]):
+            return None
+        return [(len(args) - 1, '')]
+    if kind == 'gs':
+        outputs = []
+        for index, arg in enumerate(args):
+            if arg.startswith('-sOutputFile='):
+                outputs.append((index, '-sOutputFile='))
+            elif arg == '-o' and index + 1 < len(args):
+                outputs.append((index + 1, ''))
+        if len(outputs) != 1:
+            return None
+        index, prefix = outputs[0]
+        value = args[index][len(prefix):]
+        if '%' in value or value in ('-', '') or value.startswith('|'):
+            return None
+        return outputs
+    if kind == 'ffmpeg':
+        inputs = [args[index + 1] for index, arg in enumerate(args[:-1]) if arg == '-i']
+        if 'glob' in args or any(FRAME_NUMBER_PATTERN.search(value) for value in inputs):
+            # Image sequences read files the key cannot see.
+            return None
+        # Only a single trailing output that is not the value of an option.
+        positional = [
+            index for index, arg in enumerate(args)
+            if index > 0 and not arg.startswith('-') and not args[index - 1].startswith('-')
+        ]
+        if positional != [len(args) - 1] or args[-1] == '-' or '%' in args[-1] or ':' in args[-1]:
+            return None
+        return [(len(args) - 1, '')]
+    if kind == 'pngquant':
+        for index, arg in enumerate(args):
+            if arg in ('--output', '-o') and index + 1 < len(args) and args[index + 1] != '-':
+                return [(index + 1, '')]
+        return None
+    if kind == 'exiftool':
+        if any('=' in arg or arg.lower() in EXIFTOOL_WRITE_OPTIONS for arg in args):
+            return None
+        return []
+    # wkhtmltoimage renders HTML, whose linked stylesheets, images and scripts
+    # are not part of the key, so it is never cached.
+    return None
+
+def _is_indirect_input(arg):
+    """
+    Whether the argument makes the tool read files that are not named by it:
+    an "@file" list or a wildcard pattern that matches files.
+    """
+    path = _strip_format_prefix(arg)
+    if path.startswith('@') and len(path) > 1:
+        return True
+    return glob.has_magic(path) and not os.path.exists(path) and bool(glob.glob(path))
+
+class RenditionCache:
+    """
+    Size-capped LRU cache of tool outputs keyed by input content, normalised
+    arguments and tool version. Entries are directories under entries/ whose
+    meta.json mtime tracks the last use; a per-key flock makes containers
+    sharing the cache compute each rendition only once. index.json keeps the
+    running size total, so the entries are only walked when it exceeds the cap.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_RENDITION_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        self.hashes_dir = os.path.join(cache_dir, 'hashes')
+        self.locks_dir = os.path.join(cache_dir, 'locks')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        for directory in (self.entries_dir, self.hashes_dir, self.locks_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def content_hash(self, path):
+        """
+        SHA-256 of a file, memoised by device, inode, size and mtime so
+        repeated inputs are not re-read.
+        """
+        stat = os.stat(path)
+        identity = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        memo_path = os.path.join(self.hashes_dir, hashlib.sha256(identity.encode()).hexdigest())
+        try:
+            with open(memo_path, 'r') as handle:
+                return handle.read().strip()
+        except OSError:
+            pass
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        with contextlib.suppress(OSError):
+            with open(f"{memo_path}.{os.getpid()}.tmp", 'w') as handle:
+                handle.write(digest)
+            os.replace(f"{memo_path}.{os.getpid()}.tmp", memo_path)
+        return digest
+
+    def _normalise_arg(self, arg):
+        path = _strip_format_prefix(arg)
+        frame_match = FRAME_SUFFIX_PATTERN.match(path)
+        if frame_match and not os.path.isfile(path):
+            # ImageMagick frame or geometry selection such as "input.tif[0]"
+            path = frame_match.group(1)
+        if os.path.isfile(path):
+            return f"@input:{self.content_hash(path)}@:{arg.replace(path, '', 1)}"
+        option, separator, value = arg.partition('=')
+        if separator and os.path.isfile(value):
+            return f"{option}=@input:{self.content_hash(value)}@"
+        return arg
+
+    def key(self, binary, args, outputs):
+        """
+        Cache key from the tool binary's identity, the arguments with input
+        files replaced by their content hashes and outputs replaced by their
+        position and extension. Returns None if an argument is a directory.
+        """
+        stat = os.stat(binary)
+        output_indexes = {index: prefix for index, prefix in outputs}
+        normalised = []
+        for index, arg in enumerate(args):
+            if index in output_indexes:
+                prefix = output_indexes[index]
+                target = arg[len(prefix):]
+                match = FORMAT_PREFIX_PATTERN.match(target)
+                output_format = match.group(1) if match else ''
+                normalised.append(f"{prefix}@output:{output_format}:{os.path.splitext(target)[1].lower()}@")
+            elif os.path.isdir(arg):
+                return None
+            else:
+                normalised.append(self._normalise_arg(arg))
+        material = {
+            "format": CACHE_FORMAT_VERSION,
+            "tool": [os.path.basename(binary), os.path.realpath(binary), stat.st_size, stat.st_mtime_ns],
+            "args": normalised,
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+        Holds an exclusive flock on the key's own lock file, so only callers
+        of the same rendition wait for each other. The file is removed on
+        release; a waiter that got the lock on a removed file tries again.
+        """
+        path = os.path.join(self.locks_dir, key)
+        while True:
+            handle = open(path, 'a')
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            try:
+                locked, current = os.fstat(handle.fileno()), os.stat(path)
+                if (locked.st_dev, locked.st_ino) == (current.st_dev, current.st_ino):
+                    break
+            except FileNotFoundError:
+                pass
+            handle.close()
+        try:
+            yield
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            handle.close()
+
+    def lookup(self, key, output_paths):
+        """
+        Restores a cached rendition to output_paths. Returns the cached stdout
+        bytes, or None on a miss.
+        """
+        entry_dir = os.path.join(self.entries_dir, key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        try:
+            with open(meta_path, 'r') as handle:
+                meta = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if meta.get('outputs') != len(output_paths):
+            return None
+        try:
+            with open(os.path.join(entry_dir, 'stdout'), 'rb') as handle:
+                stdout = handle.read()
+            for index, path in enumerate(output_paths):
+                clone_file(os.path.join(entry_dir, str(index)), path)
+            os.utime(meta_path)
+        except OSError:
+            # Evicted by another container while restoring.
+            return None
+        return stdout
+
+    @contextlib.contextmanager
+    def _index(self):
+        """
+        Yields the cache index dict under an exclusive flock and writes it
+        back when the block completes.
+        """
+        with open(f"{self.index_path}.lock", 'a') as lock_handle:
+            fcntl.flock(lock_handle.fileno(), fcntl.LOCK_EX)
+            try:
+                with open(self.index_path, 'r') as handle:
+                    index = json.load(handle)
+            except (OSError, ValueError):
+                index = {}
+            yield index
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as handle:
+                json.dump(index, handle)
+            os.replace(temp_path, self.index_path)
+
+    def store(self, key, output_paths, stdout):
+        entry_dir = os.path.join(self.entries_dir, key)
+        staging_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(staging_dir)
+            for index, path in enumerate(output_paths):
+                clone_file(path, os.path.join(staging_dir, str(index)))
+            with open(os.path.join(staging_dir, 'stdout'), 'wb') as handle:
+                handle.write(stdout)
+            with open(os.path.join(staging_dir, 'meta.json'), 'w') as handle:
+                json.dump({"outputs": len(output_paths)}, handle)
+            added = _entry_size(staging_dir) - _entry_size(entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(staging_dir, entry_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        now = time.time()
+        with self._index() as index:
+            # Without a total (new or pre-index cache) the eviction walk sets it.
+            needs_eviction = "bytes" not in index
+            if not needs_eviction:
+                index["bytes"] = max(0, index["bytes"] + added)
+                needs_eviction = index["bytes"] > self.max_bytes
+            expire_memos = now - index.get("hash_memos_expired_at", 0) >= HASH_MEMO_SWEEP_INTERVAL
+            if expire_memos:
+                index["hash_memos_expired_at"] = now
+        if needs_eviction:
+            self.evict(keep=entry_dir)
+        if expire_memos:
+            self.expire_hash_memos()
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries once the cache exceeds max_bytes,
+        down to EVICTION_TARGET_RATIO of it, and records the new total.
+        """
+        with self._index() as index:
+            entries = []
+            for name in os.listdir(self.entries_dir):
+                entry_dir = os.path.join(self.entries_dir, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    last_used = os.stat(os.path.join(entry_dir, 'meta.json')).st_mtime
+                    size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry_dir))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                target = self.max_bytes * EVICTION_TARGET_RATIO
+                for _, size, entry_dir in sorted(entries):
+                    if total <= target:
+                        break
+                    if entry_dir == keep:
+                        continue
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    total -= size
+            index["bytes"] = total
+
+    def expire_hash_memos(self):
+        """
+        Removes content hash memos not used within HASH_MEMO_MAX_AGE.
+        """
+        expiry = time.time() - HASH_MEMO_MAX_AGE
+        for entry in os.scandir(self.hashes_dir):
+            with contextlib.suppress(OSError):
+                if entry.stat().st_mtime < expiry:
+                    os.unlink(entry.path)
+
+def _entry_size(entry_dir):
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+    except FileNotFoundError:
+        return 0
+
+def clone_file(source, target):
+    """
+    Copies source to target, as a reflink where the filesystem supports it.
+    Hardlinks are avoided so callers can never modify a cached rendition.
+    """
+    temp_target = f"{target}.{os.getpid()}.tmp"
+    try:
+        try:
+            with open(source, 'rb') as src, open(temp_target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfile(source, temp_target)
+        os.replace(temp_target, target)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_target)
+
+def _str_to_bool(value):
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def _is_gs_preview(args, max_resolution):
+    device = next((arg.split('=', 1)[1] for arg in args if arg.startswith('-sDEVICE=')), '')
+    if not GS_RASTER_DEVICE_PATTERN.match(device):
+        return False
+    resolution = GS_DEFAULT_RESOLUTION
+    for arg in args:
+        match = re.fullmatch(r'-r(\d+(?:\.\d+)?)(?:x(\d+(?:\.\d+)?))?', arg)
+        if match:
+            resolution = max(float(match.group(1)), float(match.group(2) or 0))
+    return resolution <= max_resolution
+
+def _ffmpeg_output_indexes(args):
+    outputs = []
+    for index, arg in enumerate(args):
+        if arg.startswith('-') and arg != '-':
+            continue
+        previous = args[index - 1] if index > 0 else ''
+        if not previous.startswith('-') or previous in FFMPEG_FLAG_OPTIONS:
+            outputs.append(index)
+    return outputs
+
+def _ffmpeg_codec_options(output_options, threads):
+    codec = None
+    for index, arg in enumerate(output_options[:-1]):
+        if arg in FFMPEG_VIDEO_CODEC_OPTIONS:
+            codec = output_options[index + 1]
+    if codec == 'libx265' and '-x265-params' not in output_options:
+        # x265 sizes its own thread pool from the host CPUs and ignores -threads.
+        return ['-x265-params', f'pools={threads}']
+    if codec == 'libvpx-vp9' and '-row-mt' not in output_options:
+        # Without row multithreading libvpx-vp9 uses at most one thread per tile column.
+        return ['-row-mt', '1']
+    return []
+
+def _tune_ffmpeg(args, threads):
+    """
+    Caps ffmpeg at the per-worker thread budget: -filter_threads and
+    -filter_complex_threads globally, -threads for every input (including
+    dav1d decoding) and output (libx264, libvpx), and the libx265 pool size.
+    Options given explicitly are left alone.
+    """
+    value = str(threads)
+    outputs = set(_ffmpeg_output_indexes(args))
+    tuned = [
+        option for name in ('-filter_threads', '-filter_complex_threads') if name not in args
+        for option in (name, value)
+    ]
+    group_start = 0
+    for index, arg in enumerate(args):
+        if arg == '-i' or index in outputs:
+            group = args[group_start:index]
+            if '-threads' not in group:
+                tuned += ['-threads', value]
+            if index in outputs:
+                tuned += _ffmpeg_codec_options(group, threads)
+        tuned.append(arg)
+        if index in outputs or (index > 0 and args[index - 1] == '-i'):
+            group_start = index + 1
+    return tuned
+
+def tune_args(binary, args):
+    """
+    Adds tuning options to an invocation. With GS_PREVIEW_NOINTERPOLATE,
+    Ghostscript renders preview-class jobs (a raster device at no more than
+    GS_PREVIEW_MAX_RESOLUTION dpi) without image interpolation. With
+    FFMPEG_THREADS, ffmpeg keeps to that many threads per job.
+    """
+    if tool_kind(binary) == 'ffmpeg':
+        threads = _parse_int(os.getenv('FFMPEG_THREADS'), 0)
+        if threads > 0 and '-i' in args:
+            return _tune_ffmpeg(args, threads)
+        return args
+    if (
+        tool_kind(binary) == 'gs'
+        and _str_to_bool(os.getenv('GS_PREVIEW_NOINTERPOLATE'))
+        and '-dNOINTERPOLATE' not in args
+        and _is_gs_preview(args, _parse_int(os.getenv('GS_PREVIEW_MAX_RESOLUTION'), DEFAULT_GS_PREVIEW_MAX_RESOLUTION))
+    ):
+        return ['-dNOINTERPOLATE'] + args
+    return args
+
+def image_dimensions(path):
+    """
+    Reads the pixel dimensions from a PNG, GIF, BMP, JPEG, TIFF or PSD header
+    without decoding the image. Returns (width, height) or None.
+    """
+    try:
+        with open(path, 'rb') as handle:
+            header = handle.read(32)
+            if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+                return struct.unpack('>II', header[16:24])
+            if header[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', header[6:10])
+            if header.startswith(b'BM') and len(header) >= 26:
+                width, height = struct.unpack('<ii', header[18:26])
+                return width, abs(height)
+            if header.startswith(b'8BPS') and len(header) >= 22:
+                height, width = struct.unpack('>II', header[14:22])
+                return width, height
+            if header[:4] in (b'II*\x00', b'MM\x00*'):
+                return _tiff_dimensions(handle, '<' if header[:2] == b'II' else '>', header)
+            if header.startswith(b'\xff\xd8'):
+                return _jpeg_dimensions(handle)
+    except (OSError, struct.error):
+        return None
+    return None
+
+def _tiff_dimensions(handle, order, header):
+    handle.seek(struct.unpack(f'{order}I', header[4:8])[0])
+    count = struct.unpack(f'{order}H', handle.read(2))[0]
+    values = {}
+    for _ in range(count):
+        tag, field_type, _, value = struct.unpack(f'{order}HHI4s', handle.read(12))
+        if tag in (256, 257):
+            # SHORT or LONG, stored left-justified in the value field.
+            values[tag] = struct.unpack(f'{order}{"H" if field_type == 3 else "I"}', value[:2 if field_type == 3 else 4])[0]
+    if 256 in values and 257 in values:
+        return values[256], values[257]
+    return None
+
+def _jpeg_dimensions(handle):
+    handle.seek(2)
+    while True:
+        marker = handle.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        length = struct.unpack('>H', handle.read(2))[0]
+        # Start-of-frame markers, except DHT (C4), JPG (C8) and DAC (CC).
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', handle.read(5))
+            return width, height
+        handle.seek(length - 2, os.SEEK_CUR)
+
+def estimate_memory(binary, args, bytes_per_pixel=DEFAULT_ADMISSION_BYTES_PER_PIXEL):
+    """
+    Rough peak memory of a tool invocation: the decoded pixel size of each
+    input image whose header can be read, the file size of other inputs, and
+    for Ghostscript the raster size implied by -g or -r.
+    """
+    outputs = {index for index, _ in rendition_outputs(binary, args) or []}
+    estimate = 0
+    for index, arg in enumerate(args):
+        path = _strip_format_prefix(arg)
+        frame_match = FRAME_SUFFIX_PATTERN.match(path)
+        if frame_match and not os.path.isfile(path):
+            path = frame_match.group(1)
+        if index in outputs or not os.path.isfile(path):
+            continue
+        dimensions = image_dimensions(path)
+        if dimensions:
+            estimate += dimensions[0] * dimensions[1] * bytes_per_pixel
+        else:
+            estimate += os.path.getsize(path)
+    if tool_kind(binary) == 'gs':
+        estimate = max(estimate, _gs_raster_bytes(args))
+    return estimate
+
+def _gs_raster_bytes(args):
+    width = height = None
+    for arg in args:
+        geometry = re.fullmatch(r'-g(\d+)x(\d+)', arg)
+        resolution = re.fullmatch(r'-r(\d+(?:\.\d+)?)(?:x(\d+(?:\.\d+)?))?', arg)
+        if geometry:
+            width, height = int(geometry.group(1)), int(geometry.group(2))
+        elif resolution and width is None:
+            x_dpi = float(resolution.group(1))
+            y_dpi = float(resolution.group(2) or x_dpi)
+            width, height = GS_DEFAULT_PAGE_INCHES[0] * x_dpi, GS_DEFAULT_PAGE_INCHES[1] * y_dpi
+    # Ghostscript renders 8-bit RGBA at most; a full page buffer is the worst case.
+    return int(width * height * 4) if width else 0
+
+def _parse_weights(value):
+    weights = {}
+    for item in (value or '').split(','):
+        name, separator, weight = item.partition('=')
+        if separator and weight.strip().isdigit():
+            weights[name.strip()] = int(weight)
+    return weights
+
+class AdmissionTimeout(TimeoutError):
+    pass
+
+class AdmissionController:
+    """
+    Caps the combined weight of tools running at once in a container. The
+    budget is a number of slots of slot_bytes each; a job needs the larger of
+    its tool's weight and its estimated memory in slots. Workers register in
+    a JSON state file under flock, wait in ticket order, and may only
+    overtake older waiters when that does not delay them. Each entry holds
+    a flock on its own job file for as long as it waits or runs; the kernel
+    releases it when the process dies, so entries of killed wrappers are
+    dropped without relying on PIDs, which are neither unique across
+    containers sharing ADMISSION_DIR nor stable over time.
+    """
+
+    def __init__(self, state_dir, slots, slot_bytes=DEFAULT_ADMISSION_SLOT_BYTES, weights=None,
+                 timeout=DEFAULT_ADMISSION_TIMEOUT, bytes_per_pixel=DEFAULT_ADMISSION_BYTES_PER_PIXEL):
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, 'state.json')
+        self.lock_path = os.path.join(state_dir, 'state.lock')
+        self.jobs_dir = os.path.join(state_dir, 'jobs')
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.weights = _parse_weights(DEFAULT_ADMISSION_WEIGHTS) if weights is None else weights
+        self.timeout = timeout
+        self.bytes_per_pixel = bytes_per_pixel
+
+    @classmethod
+    def from_environment(cls):
+        slots = _parse_int(os.getenv('ADMISSION_SLOTS'), 0)
+        state_dir = os.getenv('ADMISSION_DIR', '').strip()
+        if slots <= 0 or not state_dir:
+            return None
+        weights = _parse_weights(DEFAULT_ADMISSION_WEIGHTS)
+        weights.update(_parse_weights(os.getenv('ADMISSION_TOOL_WEIGHTS')))
+        return cls(
+            state_dir,
+            slots,
+            slot_bytes=max(1, _parse_size(os.getenv('ADMISSION_SLOT_BYTES'), DEFAULT_ADMISSION_SLOT_BYTES)),
+            weights=weights,
+            timeout=_parse_int(os.getenv('ADMISSION_TIMEOUT'), DEFAULT_ADMISSION_TIMEOUT),
+            bytes_per_pixel=_parse_int(os.getenv('ADMISSION_BYTES_PER_PIXEL'), DEFAULT_ADMISSION_BYTES_PER_PIXEL),
+        )
+
+    def weight(self, binary, args):
+        """
+        Slots a job needs, capped at the whole budget so oversized jobs still
+        run on their own. Tools weighted 0 bypass admission.
+        """
+        kind = tool_kind(binary)
+        base = self.weights.get(kind, self.weights.get(os.path.basename(binary), 1))
+        if base <= 0:
+            return 0
+        cost = math.ceil(estimate_memory(binary, args, self.bytes_per_pixel) / self.slot_bytes)
+        return min(self.slots, max(base, cost))
+
+    @contextlib.contextmanager
+    def _state(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.state_path, 'r') as handle:
+                        state = json.load(handle)
+                except (OSError, ValueError):
+                    state = {}
+                state.setdefault('running', {})
+                state.setdefault('waiting', {})
+                state.setdefault('next_ticket', 0)
+                for section in ('running', 'waiting'):
+                    for job in [job for job in state[section] if not self._job_alive(job)]:
+                        del state[section][job]
+                        with contextlib.suppress(OSError):
+                            os.remove(self._job_path(job))
+                yield state
+                temp_path = f"{self.state_path}.tmp"
+                with open(temp_path, 'w') as handle:
+                    json.dump(state, handle)
+                os.replace(temp_path, self.state_path)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _job_path(self, job):
+        return os.path.join(self.jobs_dir, f"{os.path.basename(job)}.lock")
+
+    def _job_alive(self, job):
+        """
+        A job is alive while some process holds the flock on its job file.
+        """
+        try:
+            fd = os.open(self._job_path(job), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    @contextlib.contextmanager
+    def _job_lock(self):
+        """
+        Creates a job file and holds an exclusive flock on it for the
+        duration of the block. Yields the job id used in the state file.
+        """
+        job = secrets.token_hex(8)
+        path = self._job_path(job)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield job
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            os.close(fd)
+
+    def _try_admit(self, state, job, weight):
+        ticket, _ = state['waiting'][job]
+        used = sum(state['running'].values())
+        reserved = sum(w for t, w in state['waiting'].values() if t < ticket)
+        if used + reserved + weight <= self.slots:
+            del state['waiting'][job]
+            state['running'][job] = weight
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def admit(self, binary, args):
+        """
+        Waits until the job fits the remaining budget and holds its slots
+        for the duration of the block. Yields the seconds spent queueing.
+
+        Raises:
+        AdmissionTimeout: If the job did not fit within the timeout.
+        """
+        weight = self.weight(binary, args)
+        if weight == 0:
+            yield 0.0
+            return
+        started = time.monotonic()
+        delay = 0.05
+        with self._job_lock() as job:
+            with self._state() as state:
+                state['waiting'][job] = [state['next_ticket'], weight]
+                state['next_ticket'] += 1
+                admitted = self._try_admit(state, job, weight)
+            while not admitted:
+                if time.monotonic() - started >= self.timeout:
+                    with self._state() as state:
+                        state['waiting'].pop(job, None)
+                    raise AdmissionTimeout(
+                        f"{os.path.basename(binary)} needs {weight} of {self.slots} admission slots; "
+                        f"gave up after {self.timeout}s"
+                    )
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                with self._state() as state:
+                    admitted = self._try_admit(state, job, weight)
+            try:
+                yield time.monotonic() - started
+            finally:
+                with self._state() as state:
+                    state['running'].pop(job, None)
+
+def _kill_with_parent():
+    """
+    Returns a preexec_fn that makes the kernel SIGKILL the child when the
+    wrapper dies, covering a SIGKILLed wrapper that cannot forward signals.
+    Returns None where prctl is unavailable.
+    """
+    try:
+        prctl = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).prctl
+    except (OSError, AttributeError):
+        return None
+    parent_pid = os.getpid()
+
+    def preexec():
+        prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+        # The wrapper may have died before prctl took effect.
+        if os.getppid() != parent_pid:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+    return preexec
+
+def run_tool(binary, args, capture_stdout=False, admission=None):
+    """
+    Runs the real tool with the wrapper's stdin/stderr and forwards
+    termination signals to it, so facility timeouts still stop the tool.
+    The tool is also killed when the wrapper itself is killed.
+
+    Returns:
+    Dict: "returncode", "stdout" (captured bytes, also forwarded to the
+    wrapper's stdout), the child's "rusage" and, with admission control,
+    "queued_seconds".
+    """
+    if admission is not None:
+        with admission.admit(binary, args) as queued_seconds:
+            return dict(run_tool(binary, args, capture_stdout), queued_seconds=round(queued_seconds, 6))
+    process = subprocess.Popen(
+        [binary] + args,
+        stdout=subprocess.PIPE if capture_stdout else None,
+        preexec_fn=_kill_with_parent(),
+    )
+
+    def forward(signum, frame):
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(process.pid, signum)
+
+    previous = {signum: signal.signal(signum, forward) for signum in FORWARDED_SIGNALS}
+    try:
+        stdout = process.stdout.read() if capture_stdout else b''
+        # wait4 instead of Popen.wait to get the child's resource usage.
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        if capture_stdout:
+            process.stdout.close()
+    if stdout:
+        sys.stdout.buffer.write(stdout)
+        sys.stdout.buffer.flush()
+    return {"returncode": process.returncode, "stdout": stdout, "rusage": rusage}
+
+def run_cached(binary, args, cache, admission=None):
+    """
+    Serves the invocation from the rendition cache, or runs the tool and
+    stores its outputs when it succeeds.
+
+    Returns:
+    Dict: The run_tool result plus "cache" ("hit", "miss" or "bypass").
+    """
+    outputs = rendition_outputs(binary, args)
+    key = cache.key(binary, args, outputs) if outputs is not None else None
+    if key is None:
+        return dict(run_tool(binary, args, admission=admission), cache="bypass")
+    output_paths = [_strip_format_prefix(args[index][len(prefix):]) for index, prefix in outputs]
+    with cache.lock(key):
+        result = _serve_cached(cache, key, output_paths)
+    if result is not None:
+        return result
+    # Queue for admission before taking the key lock again, so a queued job
+    # never holds up other callers of the same rendition.
+    admitted = admission.admit(binary, args) if admission is not None else contextlib.nullcontext(None)
+    with admitted as queued_seconds, cache.lock(key):
+        # Another caller may have stored the rendition while this one queued.
+        result = _serve_cached(cache, key, output_paths)
+        if result is None:
+            before = [_file_signature(path) for path in output_paths]
+            result = dict(run_tool(binary, args, capture_stdout=True), cache="miss")
+            # An output left over from an earlier run is not proof that this run
+            # wrote it; ImageMagick may have written numbered frames instead.
+            written = [_file_signature(path) for path in output_paths]
+            if result["returncode"] == 0 and all(after is not None and after != previous
+                                                 for previous, after in zip(before, written)):
+                try:
+                    cache.store(key, output_paths, result["stdout"])
+                except OSError as exc:
+                    print(f"Warning: Unable to store rendition in cache: {exc}", file=sys.stderr)
+    if queued_seconds is not None:
+        result["queued_seconds"] = round(queued_seconds, 6)
+    return result
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+def _serve_cached(cache, key, output_paths):
+    stdout = cache.lookup(key, output_paths)
+    if stdout is None:
+        return None
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.buffer.flush()
+    return {"returncode": 0, "stdout": stdout, "rusage": None, "cache": "hit"}
+
+def redact_args(args):
+    """
+    Masks credentials in a command line: URL user info, password/token/secret
+    option values and the argument following such an option.
+    """
+    redacted = []
+    mask_next = False
+    for arg in args:
+        if mask_next:
+            redacted.append(REDACTED)
+            mask_next = False
+            continue
+        if SECRET_OPTION_PATTERN.match(arg):
+            mask_next = True
+            redacted.append(arg)
+            continue
+        arg = URL_CREDENTIALS_PATTERN.sub(rf'\1{REDACTED}@', arg)
+        redacted.append(SECRET_ASSIGNMENT_PATTERN.sub(rf'\1{REDACTED}', arg))
+    return redacted
+
+class InvocationLog:
+    """
+    Appends one JSON line per tool invocation and rotates the file at
+    max_bytes, keeping the given number of numbered backups.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_INSTRUMENTATION_MAX_BYTES, backups=DEFAULT_INSTRUMENTATION_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def _rotate(self):
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                # Another wrapper may have rotated while we waited for the lock.
+                if os.path.getsize(self.path) < self.max_bytes:
+                    return
+                for index in range(self.backups - 1, 0, -1):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+                if self.backups > 0:
+                    os.replace(self.path, f"{self.path}.1")
+                else:
+                    os.unlink(self.path)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + "\n").encode('utf-8')
+        # A single O_APPEND write keeps concurrent wrappers from interleaving lines.
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size >= self.max_bytes:
+            with contextlib.suppress(OSError):
+                self._rotate()
+
+def invocation_record(binary, args, result, started_at, duration):
+    rusage = result.get("rusage")
+    record = {
+        "ts": round(started_at, 3),
+        "tool": os.path.basename(binary),
+        "argv": [os.path.basename(binary)] + redact_args(args),
+        "exit_code": result["returncode"],
+        "duration_seconds": round(duration, 6),
+        "user_cpu_seconds": round(rusage.ru_utime, 6) if rusage else 0.0,
+        "system_cpu_seconds": round(rusage.ru_stime, 6) if rusage else 0.0,
+        "max_rss_bytes": rusage.ru_maxrss * 1024 if rusage else 0,
+        # Block I/O counts are in 512-byte units.
+        "read_bytes": rusage.ru_inblock * 512 if rusage else 0,
+        "write_bytes": rusage.ru_oublock * 512 if rusage else 0,
+    }
+    for field in ("cache", "queued_seconds"):
+        if field in result:
+            record[field] = result[field]
+    return record
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 2:
+        print("Usage: facility_wrapper.py <binary> [args...]", file=sys.stderr)
+        return 2
+    binary, args = argv[1], tune_args(argv[1], argv[2:])
+
+    cache_dir = os.getenv('RENDITION_CACHE_DIR', '').strip()
+    log_path = os.getenv('TOOL_INSTRUMENTATION_LOG', '').strip()
+    try:
+        admission = AdmissionController.from_environment()
+    except OSError as exc:
+        print(f"Warning: Admission control unavailable: {exc}", file=sys.stderr)
+        admission = None
+    if not cache_dir and not log_path and admission is None:
+        # Nothing to do; replace this process with the tool.
+        os.execv(binary, [binary] + args)
+
+    cache = None
+    if cache_dir:
+        try:
+            cache = RenditionCache(cache_dir, _parse_size(
+                os.getenv('RENDITION_CACHE_MAX_BYTES'), DEFAULT_RENDITION_CACHE_MAX_BYTES
+            ))
+        except OSError as exc:
+            print(f"Warning: Rendition cache {cache_dir} unavailable: {exc}", file=sys.stderr)
+
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        result = run_cached(binary, args, cache, admission) if cache else run_tool(binary, args, admission=admission)
+    except AdmissionTimeout as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return ADMISSION_TIMEOUT_EXIT_CODE
+    duration = time.perf_counter() - start
+
+    if log_path:
+        log = InvocationLog(
+            log_path,
+            _parse_size(os.getenv('TOOL_INSTRUMENTATION_MAX_BYTES'), DEFAULT_INSTRUMENTATION_MAX_BYTES),
+            _parse_size(os.getenv('TOOL_INSTRUMENTATION_BACKUPS'), DEFAULT_INSTRUMENTATION_BACKUPS),
+        )
+        try:
+            log.write(invocation_record(binary, args, result, started_at, duration))
+        except OSError as exc:
+            print(f"Warning: Unable to record tool invocation in {log_path}: {exc}", file=sys.stderr)
+    return result["returncode"]
+
+if __name__ == "__main__":
+    sys.exit(main())
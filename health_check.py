@@ -1,37 +1,200 @@
+import ipaddress
+import json
 import os
 import re
 import socket
-import subprocess
+import time
 
 # Paths to log files
 service_log_path = "/opt/corpus/censhare/censhare-Service-Client/logs/service-client-internal-0.0.log"
 DEFAULT_RMI_PORT = "30550"
+DEFAULT_SCAN_STATE_PATH = "/tmp/health_check_scan_state.json"
+DEFAULT_HEALTH_SOCKET_PATH = "/tmp/cs-image-tools-health.sock"
+DEFAULT_HEALTH_CHECK_TTL = "90"
+SCAN_CHUNK_SIZE = 1024 * 1024
+PROC_NET_TCP_PATHS = ("/proc/net/tcp", "/proc/net/tcp6")
+TCP_STATE_ESTABLISHED = "01"
+SERVICE_CLIENT_CMDLINE_PATTERN = re.compile(r"ServiceClient|censhare-Service-Client")
+DEFAULT_SVC_HOST_DNS_TTL = "300"
+
+# SVC_HOST addresses by host name, with the monotonic time they expire.
+_resolved_hosts = {}
 
 # Regex patterns for successful login and service registration
 login_pattern = re.compile(r"INFO\s+: LoginAction: ServiceClientLoginAction: client token:")
 service_registration_pattern = re.compile(r"INFO\s+: LoginAction: RMIProcessClient: created new RMIProcessClient 'ClientCLIService'")
 
-def check_log_file(log_path, pattern):
-    if os.path.exists(log_path):
-        with open(log_path, 'r') as log_file:
-            for line in log_file:
-                if pattern.search(line):
-                    return True
-    return False
+def load_scan_state(state_path):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as handle:
+            state = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+def save_scan_state(state_path, state):
+    temp_path = f"{state_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            json.dump(state, handle)
+        os.replace(temp_path, state_path)
+    except OSError as exc:
+        print(f"Warning: Unable to persist log scan state to {state_path}: {exc}")
+
+def scan_log_file(log_path, patterns, state):
+    """
+    Incrementally scan a log file for the given named patterns.
+
+    The state dict records the device/inode, the byte offset of the last
+    complete line consumed and which patterns already matched, so repeated
+    calls only read bytes appended since the previous call. A new inode
+    (rotation) or a file shorter than the saved offset (truncation) restarts
+    the scan from the beginning with no matches, mirroring a full re-read.
+    Returns a dict mapping each pattern name to whether it has matched.
+    """
+    try:
+        stat = os.stat(log_path)
+    except OSError:
+        state.clear()
+        return {name: False for name in patterns}
+
+    file_id = [stat.st_dev, stat.st_ino]
+    matched = state.get('matched') or {}
+    offset = state.get('offset', 0)
+    if state.get('file_id') != file_id or stat.st_size < offset:
+        matched = {}
+        offset = 0
+    matched = {name: bool(matched.get(name)) for name in patterns}
+
+    pending = [name for name, hit in matched.items() if not hit]
+    if pending and stat.st_size > offset:
+        with open(log_path, 'rb') as log_file:
+            log_file.seek(offset)
+            remainder = b''
+            while pending:
+                chunk = log_file.read(SCAN_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = remainder + chunk
+                last_newline = data.rfind(b'\n')
+                if last_newline == -1:
+                    remainder = data
+                    continue
+                # Only consume complete lines; a partial trailing line is re-read next time.
+                complete, remainder = data[:last_newline + 1], data[last_newline + 1:]
+                offset += len(complete)
+                text = complete.decode('utf-8', errors='replace')
+                for name in list(pending):
+                    if patterns[name].search(text):
+                        matched[name] = True
+                        pending.remove(name)
+    elif not pending:
+        # Everything matched already; skip ahead without reading.
+        offset = stat.st_size
+
+    state['file_id'] = file_id
+    state['offset'] = offset
+    state['matched'] = matched
+    return matched
+
+def check_log_patterns(log_path, patterns, state_path=None):
+    state_path = state_path or os.getenv("HEALTH_CHECK_STATE_PATH", DEFAULT_SCAN_STATE_PATH)
+    state = load_scan_state(state_path)
+    matched = scan_log_file(log_path, patterns, state)
+    save_scan_state(state_path, state)
+    return matched
+
+def find_service_client_pids(proc_root="/proc"):
+    """
+    Scan /proc/*/cmdline for a Java process running the censhare Service-Client.
+    """
+    pids = []
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_root, entry, 'cmdline'), 'rb') as handle:
+                raw = handle.read()
+        except OSError:
+            # The process exited between listdir() and open(), or is not ours to read.
+            continue
+        args = [arg.decode('utf-8', errors='replace') for arg in raw.split(b'\0') if arg]
+        if not args or os.path.basename(args[0]) != 'java':
+            continue
+        if any(SERVICE_CLIENT_CMDLINE_PATTERN.search(arg) for arg in args[1:]):
+            pids.append(int(entry))
+    return pids
 
 def check_java_process():
     try:
-        result = subprocess.run(['pgrep', '-f', 'java'], stdout=subprocess.PIPE)
-        return result.returncode == 0
+        return bool(find_service_client_pids())
     except Exception as e:
         print(f"Error checking Java process: {e}")
         return False
 
+def _decode_proc_net_address(hex_address):
+    raw = bytes.fromhex(hex_address)
+    # /proc/net/tcp{,6} prints addresses as 32-bit words in host (little-endian) byte order.
+    packed = b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    address = ipaddress.ip_address(packed)
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+def read_established_remote_addresses(paths=PROC_NET_TCP_PATHS):
+    """
+    Parse /proc/net/tcp and /proc/net/tcp6 and return the remote addresses
+    of all ESTABLISHED sockets in the container's network namespace.
+    """
+    addresses = set()
+    for path in paths:
+        try:
+            with open(path, 'r') as handle:
+                next(handle, None)  # header
+                for line in handle:
+                    fields = line.split()
+                    if len(fields) < 4 or fields[3] != TCP_STATE_ESTABLISHED:
+                        continue
+                    remote_hex = fields[2].split(':')[0]
+                    try:
+                        addresses.add(_decode_proc_net_address(remote_hex))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return addresses
+
+def resolve_service_host_addresses(host, now=None):
+    """
+    Resolves SVC_HOST, caching the addresses for SVC_HOST_DNS_TTL seconds so
+    the resident monitor does not query DNS on every probe. Failed lookups
+    are not cached. Returns an empty set when the host cannot be resolved.
+    """
+    now = time.monotonic() if now is None else now
+    cached = _resolved_hosts.get(host)
+    if cached and cached[0] > now:
+        return cached[1]
+    addresses = set()
+    try:
+        for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP):
+            addresses.add(ipaddress.ip_address(info[4][0].split('%')[0]))
+    except (socket.gaierror, ValueError) as exc:
+        print(f"Unable to resolve SVC_HOST '{host}': {exc}")
+        return set()
+    ttl = os.getenv("SVC_HOST_DNS_TTL", DEFAULT_SVC_HOST_DNS_TTL).strip()
+    ttl = int(ttl) if ttl.isdigit() else int(DEFAULT_SVC_HOST_DNS_TTL)
+    _resolved_hosts[host] = (now + ttl, addresses)
+    return addresses
+
 def check_tcp_connection():
     try:
-        result = subprocess.run(['ss', '-tan'], stdout=subprocess.PIPE)
-        # Check for established TCP connections
-        return "ESTAB" in result.stdout.decode()
+        established = read_established_remote_addresses()
+        svc_host = os.getenv("SVC_HOST", "").strip()
+        if not svc_host:
+            # Without a configured server any established connection counts
+            return bool(established)
+        # An unresolvable SVC_HOST fails the check: no connection can be attributed to it.
+        return bool(established & resolve_service_host_addresses(svc_host))
     except Exception as e:
         print(f"Error checking TCP connections: {e}")
         return False
@@ -51,34 +214,92 @@ def check_rmi_port_open(port):
         print(f"RMI port {port} not reachable: {exc}")
         return False
 
-def health_check():
+def evaluate_health(scan_state=None):
+    """
+    Run all health probes and return a (status, message) tuple, where status
+    is 0 for healthy and 1 for unhealthy. When scan_state is given the log
+    scan position is kept in that dict instead of the on-disk state file.
+    """
     # Check if the Java process is running
     if not check_java_process():
-        print("Java process not running.")
-        return 1  # Indicate failure
-    
+        return 1, "Java process not running."
+
+    # Scan the log once for both login and service registration
+    patterns = {
+        'login': login_pattern,
+        'service_registration': service_registration_pattern,
+    }
+    if scan_state is None:
+        matched = check_log_patterns(service_log_path, patterns)
+    else:
+        matched = scan_log_file(service_log_path, patterns, scan_state)
+
     # Check for successful login
-    if not check_log_file(service_log_path, login_pattern):
-        print("No successful login found in logs.")
-        return 1  # Indicate failure
+    if not matched['login']:
+        return 1, "No successful login found in logs."
 
     # Check for successful service registration
-    if not check_log_file(service_log_path, service_registration_pattern):
-        print("No successful service registration found in logs.")
-        return 1  # Indicate failure
+    if not matched['service_registration']:
+        return 1, "No successful service registration found in logs."
 
     # Check if there are established TCP connections
     if not check_tcp_connection():
-        print("No established TCP connections found.")
-        return 1  # Indicate failure
+        return 1, "No established TCP connections found."
 
     rmi_port = resolve_rmi_port()
     if not check_rmi_port_open(rmi_port):
-        print(f"RMI port {rmi_port} not open.")
+        return 1, f"RMI port {rmi_port} not open."
+
+    return 0, "Service is healthy."
+
+def query_health_server(socket_path, timeout=2):
+    """
+    Fetch the cached verdict from the entrypoint's health monitor.
+    Returns None when the monitor is not running or does not answer.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            chunks = []
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        verdict = json.loads(b''.join(chunks).decode('utf-8'))
+    except (OSError, ValueError) as exc:
+        print(f"Health monitor at {socket_path} not reachable: {exc}")
+        return None
+    return verdict if isinstance(verdict, dict) else None
+
+def resolve_health_check_ttl():
+    raw = os.getenv("HEALTH_CHECK_TTL", DEFAULT_HEALTH_CHECK_TTL)
+    if str(raw).isdigit():
+        return int(raw)
+    print(f"Warning: HEALTH_CHECK_TTL '{raw}' is not numeric; falling back to {DEFAULT_HEALTH_CHECK_TTL}.")
+    return int(DEFAULT_HEALTH_CHECK_TTL)
+
+def health_check():
+    socket_path = os.getenv("HEALTH_SOCKET_PATH", DEFAULT_HEALTH_SOCKET_PATH)
+    ttl = resolve_health_check_ttl()
+
+    verdict = query_health_server(socket_path)
+    if verdict is None:
+        # No resident monitor (yet); run the probes in this process.
+        status, message = evaluate_health()
+        print(message)
+        return status
+
+    age = max(0.0, time.time() - float(verdict.get('checked_at', 0)))
+    if age > ttl:
+        print(f"Cached health verdict is stale ({age:.0f}s old, TTL {ttl}s).")
         return 1  # Indicate failure
 
-    print("Service is healthy.")
-    return 0  # Indicate success
+    print(f"{verdict.get('message', '')} (checked {age:.0f}s ago)")
+    return 0 if verdict.get('status') == 0 else 1
 
 if __name__ == "__main__":
     exit(health_check())
@@ -0,0 +1,65 @@
+import json
+import sys
+
+import benchmark
+
+
+def test_run_timed_reports_exit_code_and_resource_usage():
+    result = benchmark.run_timed([sys.executable, "-c", "import sys; sys.stderr.write('boom'); sys.exit(3)"])
+
+    assert result["returncode"] == 3
+    assert result["stderr"] == "boom"
+    assert result["seconds"] > 0
+    assert result["max_rss_kib"] > 0
+
+
+def test_run_benchmarks_measures_each_policy_and_concurrency(tmp_path):
+    tools = {"magick": sys.executable, "exiftool": sys.executable}
+    fixtures = {"jpeg": str(tmp_path / "fixture.jpg")}
+    script = "import os, sys; open(sys.argv[1], 'w').write(os.environ.get('MAGICK_THREAD_LIMIT', '-'))"
+    workloads = {
+        "fake_magick": ("magick", "jpeg", lambda tools, src, out: [tools["magick"], "-c", script, out]),
+        "fake_missing": ("gs", "pdf", lambda tools, src, out: [tools["gs"], src]),
+    }
+
+    results = benchmark.run_benchmarks(
+        tools, fixtures, workloads, [1, 2], benchmark.policy_settings([1, 2], None), 2, str(tmp_path)
+    )
+
+    measured = [entry for entry in results if "skipped" not in entry]
+    assert [(entry["concurrency"], entry["policy"]["thread"]) for entry in measured] == [
+        (1, 1), (2, 1), (1, 2), (2, 2),
+    ]
+    assert all(entry["operations"] == 2 * entry["concurrency"] for entry in measured)
+    assert all(entry["throughput_per_second"] > 0 for entry in measured)
+    assert results[-1] == {"workload": "fake_missing", "skipped": "gs or pdf fixture not available"}
+
+
+def test_compare_results_flags_throughput_regressions():
+    policy = {"thread": 2, "memory": None}
+    baseline = {"results": [
+        {"workload": "resize", "concurrency": 1, "policy": policy, "throughput_per_second": 10.0},
+        {"workload": "resize", "concurrency": 2, "policy": policy, "throughput_per_second": 18.0},
+    ]}
+    current = [
+        {"workload": "resize", "concurrency": 1, "policy": policy, "throughput_per_second": 9.5},
+        {"workload": "resize", "concurrency": 2, "policy": policy, "throughput_per_second": 12.0},
+    ]
+
+    regressions = benchmark.compare_results(current, baseline, max_regression=0.1)
+
+    assert [entry["concurrency"] for entry in regressions] == [2]
+    assert regressions[0]["change"] == round(12.0 / 18.0 - 1, 4)
+
+
+def test_main_writes_json_report_when_tools_are_missing(monkeypatch, tmp_path):
+    monkeypatch.setattr(benchmark, "resolve_tools", lambda: {})
+    output = tmp_path / "results.json"
+
+    assert benchmark.main(["--output", str(output), "--workloads", "magick_resize_jpeg"]) == 0
+
+    report = json.loads(output.read_text())
+    assert report["schema_version"] == benchmark.RESULT_SCHEMA_VERSION
+    assert report["results"] == [
+        {"workload": "magick_resize_jpeg", "skipped": "magick or jpeg fixture not available"},
+    ]
@@ -1,9 +1,20 @@
+import gzip
 import hashlib
 import importlib.util
+import io
+import json
+import os
+import re
 import sys
+import tarfile
+import threading
+import time
+import urllib.request
 from pathlib import Path
 import xml.etree.ElementTree as ET
 
+import pytest
+
 
 REPO_ROOT = Path(__file__).resolve().parent.parent
 ENTRYPOINT_PATH = REPO_ROOT / "entrypoint.py"
@@ -25,7 +36,7 @@ def test_determine_serviceclient_version(tmp_path):
 
 def test_download_unpack_logs_checksums(monkeypatch, tmp_path, capsys):
     # Prepare fake HTTP response that streams deterministic bytes
-    chunk = b"offline-archive"
+    chunk = gzip.compress(b"offline-archive")
 
     class DummyResponse:
         status_code = 200
@@ -191,6 +202,7 @@ def test_configure_imagemagick_policy_autoconfigures_from_memory_limit(monkeypat
     monkeypatch.delenv("IMAGEMAGICK_POLICY_THREAD", raising=False)
     monkeypatch.delenv("IMAGEMAGICK_POLICY_MAX_MEMORY_REQUEST", raising=False)
     monkeypatch.setattr(entrypoint, "detect_container_memory_limit_bytes", lambda: 6 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: None)
 
     entrypoint.configure_imagemagick_policy(str(policy_path))
 
@@ -205,6 +217,238 @@ def test_configure_imagemagick_policy_autoconfigures_from_memory_limit(monkeypat
     assert root.find("./policy[@domain='system'][@name='max-memory-request']").get("value") == expected["max-memory-request"]
 
 
+def test_detect_container_cpu_limit_uses_smallest_of_quota_and_cpuset(monkeypatch):
+    values = {
+        "/sys/fs/cgroup/cpu.max": "250000 100000",
+        "/sys/fs/cgroup/cpuset.cpus.effective": "0-1",
+    }
+    monkeypatch.setattr(entrypoint, "_read_first_line", lambda path: values.get(path))
+    monkeypatch.setattr(entrypoint.os, "cpu_count", lambda: 16)
+    monkeypatch.setattr(entrypoint.os, "sched_getaffinity", lambda pid: set(range(16)), raising=False)
+
+    assert entrypoint.detect_container_cpu_limit() == 2.0
+
+    values["/sys/fs/cgroup/cpuset.cpus.effective"] = "0-7,12"
+    assert entrypoint.detect_container_cpu_limit() == 2.5
+
+    values["/sys/fs/cgroup/cpu.max"] = "max 100000"
+    assert entrypoint.detect_container_cpu_limit() == 9.0
+
+
+def test_configure_imagemagick_policy_sizes_threads_from_cpu_limit(monkeypatch, tmp_path):
+    policy_path = tmp_path / "policy.xml"
+    _write_minimal_policy(policy_path)
+    monkeypatch.setenv("IMAGEMAGICK_POLICY_AUTOCONFIG", "true")
+    monkeypatch.setenv("SVC_INSTANCES", "2")
+    monkeypatch.delenv("IMAGEMAGICK_POLICY_THREAD", raising=False)
+    monkeypatch.setattr(entrypoint, "detect_container_memory_limit_bytes", lambda: 8 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: 8.0)
+
+    entrypoint.configure_imagemagick_policy(str(policy_path))
+
+    root = ET.parse(policy_path).getroot()
+    assert root.find("./policy[@domain='resource'][@name='thread']").get("value") == "4"
+
+
+def test_configure_thread_limits_exports_budget_and_keeps_explicit_values(monkeypatch):
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: 1.5)
+    monkeypatch.delenv("MAGICK_THREAD_LIMIT", raising=False)
+    monkeypatch.setenv("OMP_NUM_THREADS", "3")
+
+    assert entrypoint.configure_thread_limits(svc_instances=4) == 1
+    assert entrypoint.os.environ["MAGICK_THREAD_LIMIT"] == "1"
+    assert entrypoint.os.environ["OMP_NUM_THREADS"] == "3"
+
+
+def test_recommend_svc_instances_takes_the_tightest_limit():
+    instances, reasoning = entrypoint.recommend_svc_instances(2 * entrypoint.GIB, 8.0)
+    assert instances == 1
+    assert "limited by memory" in reasoning
+
+    instances, reasoning = entrypoint.recommend_svc_instances(64 * entrypoint.GIB, 6.5)
+    assert instances == 6
+    assert "limited by CPU" in reasoning
+
+    instances, _ = entrypoint.recommend_svc_instances(None, 64.0, max_instances=16)
+    assert instances == 16
+
+
+def test_resolve_svc_instances_supports_auto(monkeypatch, capsys):
+    monkeypatch.setattr(entrypoint, "detect_container_memory_limit_bytes", lambda: 6 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: 4.0)
+    monkeypatch.delenv("SVC_INSTANCES_MAX", raising=False)
+
+    assert entrypoint.resolve_svc_instances("auto") == 4
+    assert "SVC_INSTANCES=auto resolved to 4" in capsys.readouterr().out
+    assert entrypoint.resolve_svc_instances("3") == 3
+    assert entrypoint.resolve_svc_instances("bogus") == 4
+
+    monkeypatch.setenv("SVC_INSTANCES_MAX", "2")
+    assert entrypoint.resolve_svc_instances("AUTO") == 2
+
+
+def test_calibrate_imagemagick_policy_picks_fastest_candidate_within_budget(monkeypatch, tmp_path):
+    policy_path = tmp_path / "policy.xml"
+    _write_minimal_policy(policy_path)
+    tree = ET.parse(policy_path)
+    memory_limit = 8 * entrypoint.GIB
+    candidates = entrypoint.calibration_candidates(memory_limit, 2, cpu_limit=4.0)
+    assert candidates[0] == entrypoint.recommend_imagemagick_policy(memory_limit, 2, 4.0)
+    assert len(candidates) == 6
+
+    monkeypatch.setattr(entrypoint.benchmark, "resolve_tools", lambda binaries: {"magick": "/usr/bin/magick"})
+    monkeypatch.setattr(entrypoint, "_imagemagick_version", lambda binary: "Version: ImageMagick 7.1.2-18")
+    monkeypatch.setattr(
+        entrypoint.benchmark, "generate_fixtures", lambda tools, workdir, names: {"tiff": str(tmp_path / "f.tif")}
+    )
+    measured = []
+
+    def fake_run_workload(factory, concurrency, iterations, env, workdir):
+        root = ET.parse(policy_path).getroot()
+        memory = root.find("./policy[@name='memory']").get("value")
+        measured.append((memory, env["MAGICK_THREAD_LIMIT"], concurrency))
+        # Bigger pixel caches and more threads are faster, but the largest cache blows the RSS budget.
+        rank = [candidate["memory"] for candidate in candidates[:3]].index(memory)
+        rss_kib = 8 * 1024 * 1024 if rank == 2 else 512 * 1024
+        return {"throughput_per_second": rank + int(env["MAGICK_THREAD_LIMIT"]), "max_rss_kib": rss_kib}
+
+    monkeypatch.setattr(entrypoint.benchmark, "run_workload", fake_run_workload)
+
+    best = entrypoint.calibrate_imagemagick_policy(
+        tree, str(policy_path), memory_limit, 2, 4.0, cache_dir=str(tmp_path / "cache")
+    )
+
+    assert len(measured) == 6 and all(concurrency == 2 for _, _, concurrency in measured)
+    assert best == candidates[1]
+
+    def no_measurements(*args, **kwargs):
+        raise AssertionError("cached node shapes must not be recalibrated")
+
+    monkeypatch.setattr(entrypoint.benchmark, "run_workload", no_measurements)
+    assert entrypoint.calibrate_imagemagick_policy(
+        tree, str(policy_path), memory_limit, 2, 4.0, cache_dir=str(tmp_path / "cache")
+    ) == best
+
+
+def test_select_scratch_dir_prefers_fast_local_mounts(tmp_path):
+    overlay_dir = tmp_path / "overlay"
+    disk_dir = tmp_path / "disk"
+    nvme_dir = tmp_path / "nvme"
+    for directory in (overlay_dir, disk_dir, nvme_dir):
+        directory.mkdir()
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text(
+        "1 0 0:1 / / rw - overlay overlay rw\n"
+        f"2 1 8:1 / {disk_dir} rw - ext4 /dev/sda1 rw\n"
+        f"3 1 259:1 / {nvme_dir} rw - xfs /dev/nvme0n1p1 rw\n"
+    )
+
+    assert entrypoint.select_scratch_dir([str(overlay_dir)], mountinfo_path=str(mountinfo)) == (None, None)
+    selected, mount = entrypoint.select_scratch_dir(
+        [str(overlay_dir), str(disk_dir), str(nvme_dir)], mountinfo_path=str(mountinfo)
+    )
+    assert selected == str(nvme_dir)
+    assert mount == {"mount_point": str(nvme_dir), "fstype": "xfs", "source": "/dev/nvme0n1p1"}
+    assert entrypoint.select_scratch_dir(
+        [str(nvme_dir)], min_free_bytes=1 << 60, mountinfo_path=str(mountinfo)
+    ) == (None, None)
+
+
+def test_configure_scratch_space_exports_paths_and_sizes_disk_limit(monkeypatch, tmp_path):
+    monkeypatch.setenv("SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.delenv("MAGICK_TEMPORARY_PATH", raising=False)
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr(entrypoint.os, "geteuid", lambda: 1000)
+    usage = entrypoint.shutil.disk_usage(tmp_path)._replace(free=20 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint.shutil, "disk_usage", lambda path: usage)
+    scratch_root = tmp_path / "scratch"
+    stale = scratch_root / "cs-image-tools-gone" / "magick" / "magick-stale"
+    stale.parent.mkdir(parents=True)
+    stale.write_text("spill")
+    (scratch_root / "cs-image-tools-gone.lock").write_text("")
+    # Another container on the same mount still holds its lock.
+    live = scratch_root / "cs-image-tools-live" / "magick" / "magick-spill"
+    live.parent.mkdir(parents=True)
+    live.write_text("spill")
+    live_lock = open(scratch_root / "cs-image-tools-live.lock", "w")
+    entrypoint.fcntl.flock(live_lock.fileno(), entrypoint.fcntl.LOCK_EX)
+    monkeypatch.setattr(entrypoint, "_scratch_lock_fds", [])
+
+    try:
+        scratch = entrypoint.configure_scratch_space(svc_instances=4)
+    finally:
+        live_lock.close()
+        for fd in entrypoint._scratch_lock_fds:
+            entrypoint.os.close(fd)
+
+    magick_dir = Path(scratch["temporary-path"])
+    assert magick_dir.parent.parent == scratch_root
+    assert magick_dir.parent.name.startswith("cs-image-tools-")
+    assert scratch["disk"] == "4GiB"
+    assert entrypoint.os.environ["MAGICK_TEMPORARY_PATH"] == str(magick_dir)
+    assert entrypoint.os.environ["TMPDIR"] == str(tmp_path)
+    assert not stale.exists()
+    assert not (scratch_root / "cs-image-tools-gone.lock").exists()
+    assert live.exists()
+
+    policy_path = tmp_path / "policy.xml"
+    _write_minimal_policy(policy_path)
+    monkeypatch.delenv("IMAGEMAGICK_POLICY_DISK", raising=False)
+    entrypoint.configure_imagemagick_policy(str(policy_path), scratch=scratch)
+    root = ET.parse(policy_path).getroot()
+    assert root.find("./policy[@name='temporary-path']").get("value") == str(magick_dir)
+    assert root.find("./policy[@name='disk']").get("value") == "4GiB"
+
+
+def test_recommend_ghostscript_profile_bands_pages_when_threaded():
+    threaded = entrypoint.recommend_ghostscript_profile(16 * entrypoint.GIB, 2, cpu_limit=8)
+    assert threaded["NumRenderingThreads"] == 4
+    assert threaded["MaxBitmap"] == entrypoint.GS_THREADED_MAX_BITMAP
+    assert threaded["BandBufferSpace"] == 64 * entrypoint.MIB
+    assert threaded["BufferSpace"] == 64 * entrypoint.MIB
+
+    single = entrypoint.recommend_ghostscript_profile(2 * entrypoint.GIB, 4, cpu_limit=2)
+    assert "NumRenderingThreads" not in single
+    # The reserve is capped at 35% of 2GiB, leaving about 333MiB per worker.
+    per_worker = (2 * entrypoint.GIB - int(2 * entrypoint.GIB * 0.35)) // 4
+    assert single["MaxBitmap"] == per_worker // 4
+    assert single["BandBufferSpace"] == 64 * entrypoint.MIB
+
+
+def test_configure_ghostscript_options_keeps_explicit_value(monkeypatch):
+    monkeypatch.setenv("GS_OPTIONS", "-dNumRenderingThreads=1")
+    assert entrypoint.configure_ghostscript_options() is None
+    assert entrypoint.os.environ["GS_OPTIONS"] == "-dNumRenderingThreads=1"
+
+    monkeypatch.delenv("GS_OPTIONS")
+    monkeypatch.setattr(entrypoint, "detect_container_memory_limit_bytes", lambda: 8 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: 4.0)
+
+    options = entrypoint.configure_ghostscript_options(svc_instances=2)
+
+    assert options.startswith("-dBufferSpace=")
+    assert "-dNumRenderingThreads=2" in options
+    assert entrypoint.os.environ["GS_OPTIONS"] == options
+
+
+def test_configure_admission_control_sizes_slots_from_memory_limit(monkeypatch, tmp_path):
+    monkeypatch.delenv("ADMISSION_CONTROL", raising=False)
+    assert entrypoint.configure_admission_control() is None
+
+    monkeypatch.setenv("ADMISSION_CONTROL", "true")
+    monkeypatch.setenv("ADMISSION_DIR", str(tmp_path / "admission"))
+    monkeypatch.delenv("ADMISSION_SLOTS", raising=False)
+    monkeypatch.delenv("ADMISSION_SLOT_BYTES", raising=False)
+    monkeypatch.setattr(entrypoint, "detect_container_memory_limit_bytes", lambda: 8 * entrypoint.GIB)
+    monkeypatch.setattr(entrypoint.os, "geteuid", lambda: 1000)
+
+    # 8GiB minus the 20% reserve leaves 6.4GiB, i.e. 25 slots of 256MiB.
+    assert entrypoint.configure_admission_control() == 25
+    assert entrypoint.os.environ["ADMISSION_SLOTS"] == "25"
+    assert (tmp_path / "admission").is_dir()
+    assert "admission_control" in entrypoint.facility_wrapper_features()
+
+
 def test_configure_imagemagick_policy_keeps_bundled_defaults_by_default(monkeypatch, tmp_path):
     policy_path = tmp_path / "policy.xml"
     _write_minimal_policy(policy_path)
@@ -274,3 +518,986 @@ def test_update_facility_paths_enables_ffmpeg_when_present(monkeypatch):
     entrypoint.update_facility_paths(facility, "ffmpeg", office_url="")
 
     assert facility.get("enabled") == "true"
+
+
+def test_update_facility_paths_routes_binaries_through_wrapper(monkeypatch, tmp_path):
+    monkeypatch.setenv("RENDITION_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("FACILITY_WRAPPER_DIR", str(tmp_path / "wrappers"))
+    facility = _facility_xml("ffmpeg", enabled="false", path_key="@@FFMPEG-PATH@@", path_value="/usr/local/bin/ffmpeg")
+    video = _facility_xml("video", enabled="true", path_key="@@FFMPEG-PATH@@", path_value="/usr/local/bin/ffmpeg")
+    monkeypatch.setattr(entrypoint.os.path, "exists", lambda path: path == "/usr/local/bin/ffmpeg")
+    monkeypatch.setattr(entrypoint.os, "access", lambda path, mode: path == "/usr/local/bin/ffmpeg")
+
+    entrypoint.update_facility_paths(facility, "ffmpeg", office_url="")
+    entrypoint.update_facility_paths(video, "video", office_url="")
+
+    shim = str(tmp_path / "wrappers" / "ffmpeg")
+    assert facility.find(".//path").get("path") == shim
+    assert facility.get("enabled") == "true"
+    assert video.find(".//path").get("path") == shim
+
+
+def test_ffmpeg_thread_profile_only_wraps_ffmpeg(monkeypatch, tmp_path):
+    for name in ("RENDITION_CACHE_DIR", "TOOL_INSTRUMENTATION_LOG", "ADMISSION_CONTROL", "GS_PREVIEW_NOINTERPOLATE"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.delenv("FFMPEG_AUTOCONFIG", raising=False)
+    monkeypatch.delenv("FFMPEG_THREADS", raising=False)
+    monkeypatch.setenv("FACILITY_WRAPPER_DIR", str(tmp_path / "wrappers"))
+    monkeypatch.setattr(entrypoint, "detect_container_cpu_limit", lambda: 6.0)
+
+    assert entrypoint.facility_wrapper_paths() == {"/usr/local/bin/ffmpeg": str(tmp_path / "wrappers" / "ffmpeg")}
+    assert entrypoint.configure_ffmpeg_threads(svc_instances=3) == 2
+    assert entrypoint.os.environ["FFMPEG_THREADS"] == "2"
+
+
+def test_install_facility_wrappers_writes_exec_shims(monkeypatch, tmp_path):
+    monkeypatch.delenv("RENDITION_CACHE_DIR", raising=False)
+    monkeypatch.delenv("TOOL_INSTRUMENTATION_LOG", raising=False)
+    monkeypatch.setenv("FFMPEG_AUTOCONFIG", "false")
+    assert entrypoint.install_facility_wrappers() == {}
+
+    monkeypatch.setenv("RENDITION_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("FACILITY_WRAPPER_DIR", str(tmp_path / "wrappers"))
+    monkeypatch.setattr(entrypoint.os, "geteuid", lambda: 1000)
+
+    wrappers = entrypoint.install_facility_wrappers()
+
+    shim = tmp_path / "wrappers" / "gs"
+    assert wrappers["/usr/local/bin/gs"] == str(shim)
+    assert shim.read_text() == '#!/bin/sh\nexec python3 -S /usr/local/bin/facility_wrapper.py /usr/local/bin/gs "$@"\n'
+    assert entrypoint.os.access(shim, entrypoint.os.X_OK)
+    assert (tmp_path / "cache" / "entries").is_dir()
+
+
+def test_start_health_monitor_serves_cached_verdict(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_evaluate(scan_state):
+        calls.append(scan_state)
+        return 0, "Service is healthy."
+
+    monkeypatch.setattr(entrypoint.health_check, "evaluate_health", fake_evaluate)
+    socket_path = str(tmp_path / "health.sock")
+
+    server = entrypoint.start_health_monitor(socket_path=socket_path, interval=1)
+    try:
+        deadline = time.time() + 5
+        verdict = None
+        while time.time() < deadline:
+            verdict = entrypoint.health_check.query_health_server(socket_path)
+            if verdict and verdict["status"] == 0:
+                break
+            time.sleep(0.05)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert verdict["status"] == 0
+    assert verdict["message"] == "Service is healthy."
+    assert calls and isinstance(calls[0], dict)
+
+
+def _fake_stay_open_exiftool(tmp_path):
+    """A stand-in for `exiftool -stay_open True -@ -` that echoes its arguments."""
+    tool = tmp_path / "exiftool"
+    tool.write_text(
+        f"#!{sys.executable}\n"
+        "import json, sys\n"
+        "args = []\n"
+        "for line in sys.stdin:\n"
+        "    arg = line.rstrip('\\n')\n"
+        "    if arg == 'False' and args == ['-stay_open']:\n"
+        "        break\n"
+        "    if not arg.startswith('-execute'):\n"
+        "        args.append(arg)\n"
+        "        continue\n"
+        "    marker = args[args.index('-echo4') + 1]\n"
+        "    args = args[:args.index('-echo4')]\n"
+        "    if 'crash' in args:\n"
+        "        sys.exit(1)\n"
+        "    status = 0\n"
+        "    if 'bad' in args:\n"
+        "        sys.stderr.write('Error: bad file\\n')\n"
+        "        status = 1\n"
+        "    if 'quiet-bad' in args:\n"
+        "        status = 1\n"
+        "    if '-if' in args:\n"
+        "        status = 2\n"
+        "    sys.stdout.write(json.dumps(args) + '\\n' + '{ready' + arg[8:] + '}\\n')\n"
+        "    sys.stdout.flush()\n"
+        "    sys.stderr.write(marker.replace('${status}', str(status)) + '\\n')\n"
+        "    sys.stderr.flush()\n"
+        "    args = []\n"
+    )
+    tool.chmod(0o755)
+    return str(tool)
+
+
+def test_exiftool_daemon_serves_requests_and_recovers_from_crashes(monkeypatch, tmp_path, capfdbinary):
+    monkeypatch.setattr(entrypoint.os, "geteuid", lambda: 1000)
+    socket_path = str(tmp_path / "exiftool.sock")
+    server = entrypoint.start_exiftool_daemon(socket_path, instances=1, timeout=5, binary=_fake_stay_open_exiftool(tmp_path))
+    capfdbinary.readouterr()
+    try:
+        assert entrypoint.exiftool_client.run_via_daemon(["-j", "/a.jpg"], socket_path, 10) == 0
+        assert entrypoint.exiftool_client.run_via_daemon(["crash"], socket_path, 10) == 1
+        assert entrypoint.exiftool_client.run_via_daemon(["bad"], socket_path, 10) == 1
+        assert entrypoint.exiftool_client.run_via_daemon(["-q", "-q", "quiet-bad"], socket_path, 10) == 1
+        assert entrypoint.exiftool_client.run_via_daemon(["-if", "$Make", "/a.jpg"], socket_path, 10) == 2
+        assert entrypoint.exiftool_client.run_via_daemon(["-ver"], socket_path, 10) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    stdout, stderr = capfdbinary.readouterr()
+    # Other tests' background threads may print too, so only the relayed lines are checked.
+    relayed = [line for line in stdout.splitlines() if line.startswith(b"[")]
+    assert relayed == [
+        b'["-j", "/a.jpg"]', b'["bad"]', b'["-q", "-q", "quiet-bad"]', b'["-if", "$Make", "/a.jpg"]', b'["-ver"]',
+    ]
+    assert b"Error: exiftool daemon: exiftool exited" in stderr
+    assert b"Error: bad file" in stderr
+
+
+def test_facility_metrics_pairs_jobs_and_renders_histograms(monkeypatch):
+    monkeypatch.setenv("METRICS_JOB_START_PATTERN", r"^INFO\s+: (?P<facility>\w+): job started")
+    monkeypatch.setenv("METRICS_JOB_END_PATTERN", r"^INFO\s+: (?P<facility>\w+): job (?:finished|(?P<status>failed))")
+    metrics = entrypoint.FacilityMetrics(svc_instances=2)
+
+    metrics.observe_line("INFO   : imagemagick: job started", now=10.0)
+    metrics.observe_line("INFO   : Facility imagemagick started (path /usr/bin/convert)", now=10.5)
+    metrics.observe_line("INFO   : ghostscript: job started", now=11.0)
+    metrics.observe_line("INFO   : imagemagick: job finished", now=13.0)
+    rendered = metrics.render()
+
+    assert 'cs_facility_jobs_started_total{facility="imagemagick"} 1' in rendered
+    assert 'cs_facility_jobs_finished_total{facility="imagemagick",status="success"} 1' in rendered
+    assert 'cs_facility_jobs_in_flight{facility="ghostscript"} 1' in rendered
+    assert 'cs_facility_job_duration_seconds_bucket{facility="imagemagick",le="2.5"} 0' in rendered
+    assert 'cs_facility_job_duration_seconds_bucket{facility="imagemagick",le="5"} 1' in rendered
+    assert 'cs_facility_job_duration_seconds_sum{facility="imagemagick"} 3.000000' in rendered
+    assert "cs_service_client_saturation_ratio 0.500000" in rendered
+
+
+def test_facility_metrics_supports_custom_patterns_with_job_ids():
+    metrics = entrypoint.FacilityMetrics(
+        svc_instances=1,
+        start_pattern=re.compile(r"START (?P<facility>\w+) #(?P<job>\d+)"),
+        end_pattern=re.compile(r"(?P<status>FAIL)?END (?P<facility>\w+) #(?P<job>\d+)"),
+    )
+
+    metrics.observe_line("START ffmpeg #1", now=0.0)
+    metrics.observe_line("START ffmpeg #2", now=1.0)
+    metrics.observe_line("FAILEND ffmpeg #2", now=2.0)
+    rendered = metrics.render()
+
+    assert 'cs_facility_jobs_finished_total{facility="ffmpeg",status="failure"} 1' in rendered
+    assert 'cs_facility_jobs_in_flight{facility="ffmpeg"} 1' in rendered
+
+
+def test_facility_metrics_drops_job_starts_that_never_end():
+    metrics = entrypoint.FacilityMetrics(
+        svc_instances=1,
+        start_pattern=re.compile(r"START (?P<facility>\w+)(?: #(?P<job>\d+))?"),
+        end_pattern=re.compile(r"END (?P<facility>\w+)"),
+    )
+
+    metrics.observe_line("START ffmpeg", now=0.0)
+    metrics.observe_line("START ffmpeg #1", now=0.0)
+    for _ in range(entrypoint.JOB_PENDING_MAX + 5):
+        metrics.observe_line("START office", now=1.0)
+    assert 'cs_facility_jobs_in_flight{facility="office"} 1024' in metrics.render()
+
+    metrics.observe_line("START office", now=entrypoint.JOB_PENDING_MAX_AGE + 0.5)
+    rendered = metrics.render()
+
+    assert 'cs_facility_jobs_in_flight{facility="ffmpeg"} 0' in rendered
+    assert 'cs_facility_jobs_in_flight{facility="office"} 1024' in rendered
+
+
+def test_facility_metrics_without_job_patterns_only_renders_instance_and_tool_metrics(monkeypatch):
+    monkeypatch.delenv("METRICS_JOB_START_PATTERN", raising=False)
+    monkeypatch.delenv("METRICS_JOB_END_PATTERN", raising=False)
+    metrics = entrypoint.FacilityMetrics(svc_instances=2)
+
+    metrics.observe_line("INFO   : Facility imagemagick started (path /usr/bin/convert)", now=1.0)
+    rendered = metrics.render()
+
+    assert not metrics.job_metrics
+    assert "cs_service_client_instances 2" in rendered
+    assert "cs_facility_jobs_started_total" not in rendered
+
+
+def test_facility_metrics_aggregates_tool_instrumentation_records():
+    metrics = entrypoint.FacilityMetrics(svc_instances=1)
+
+    metrics.observe_tool_record(json.dumps({
+        "tool": "gs", "exit_code": 0, "duration_seconds": 1.5, "user_cpu_seconds": 1.0,
+        "max_rss_bytes": 2048, "read_bytes": 512, "cache": "miss",
+    }))
+    metrics.observe_tool_record(json.dumps({"tool": "gs", "exit_code": 1, "duration_seconds": 0.5, "max_rss_bytes": 1024}))
+    metrics.observe_tool_record("not json")
+    rendered = metrics.render()
+
+    assert 'cs_tool_invocations_total{tool="gs",status="success"} 1' in rendered
+    assert 'cs_tool_invocations_total{tool="gs",status="failure"} 1' in rendered
+    assert 'cs_tool_rendition_cache_total{tool="gs",result="miss"} 1' in rendered
+    assert 'cs_tool_duration_seconds_total{tool="gs"} 2.000000' in rendered
+    assert 'cs_tool_read_bytes_total{tool="gs"} 512' in rendered
+    assert 'cs_tool_max_rss_bytes{tool="gs"} 2048' in rendered
+
+
+def test_start_metrics_exporter_serves_metrics_endpoint(monkeypatch, capsys):
+    monkeypatch.delenv("METRICS_BIND", raising=False)
+    monkeypatch.delenv("METRICS_JOB_START_PATTERN", raising=False)
+    monkeypatch.delenv("METRICS_JOB_END_PATTERN", raising=False)
+    metrics = entrypoint.FacilityMetrics(svc_instances=4)
+    server = entrypoint.start_metrics_exporter(metrics, port=0)
+    assert server.server_address[0] == "127.0.0.1"
+    assert "facility job metrics are disabled" in capsys.readouterr().out
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert "cs_service_client_instances 4" in body
+
+
+def _start_fake_office(status, delay=0, requests=None):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if requests is not None:
+                requests.append(body)
+            time.sleep(delay)
+            payload = f"{self.path}:{body.decode()}".encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            except BrokenPipeError:
+                pass  # The proxy gave up waiting.
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/convert"
+
+
+def test_office_proxy_balances_by_outstanding_requests_and_caps_concurrency():
+    proxy = entrypoint.OfficeProxy(["http://a.invalid/", "http://b.invalid/"], max_concurrency=1, queue_timeout=0)
+
+    first = proxy.acquire()
+    second = proxy.acquire()
+    assert {first.url, second.url} == {"http://a.invalid/", "http://b.invalid/"}
+    assert proxy.acquire() is None
+
+    proxy.release(first)
+    proxy.mark(second, False, "down")
+    proxy.release(second)
+    assert proxy.acquire() is first
+    assert first.target("/?page=1") == "/?page=1"
+    assert entrypoint.OfficeBackend("http://x.invalid/convert?fmt=pdf", 1).target("/?page=1") == "/convert?fmt=pdf&page=1"
+
+
+def test_office_proxy_fails_over_to_a_healthy_backend():
+    failing, failing_url = _start_fake_office(503)
+    working, working_url = _start_fake_office(200)
+    server = entrypoint.start_office_proxy([failing_url, working_url], bind="127.0.0.1", port=0)
+    try:
+        port = server.server_address[1]
+        for _ in range(2):
+            request = urllib.request.Request(f"http://127.0.0.1:{port}/", data=b"document", method="POST")
+            with urllib.request.urlopen(request, timeout=5) as response:
+                assert response.status == 200
+                assert response.read() == b"/convert:document"
+    finally:
+        for running in (server, failing, working):
+            running.shutdown()
+            running.server_close()
+
+    backends = server.office_proxy.backends
+    assert [backend.healthy for backend in backends] == [False, True]
+    assert [backend.outstanding for backend in backends] == [0, 0]
+
+
+def test_office_proxy_does_not_fail_over_after_a_read_timeout():
+    received = []
+    slow, slow_url = _start_fake_office(200, delay=1, requests=received)
+    working, working_url = _start_fake_office(200, requests=received)
+    proxy = entrypoint.OfficeProxy([slow_url, working_url], timeout=0.2)
+    try:
+        with pytest.raises(entrypoint.OfficeProxyError) as error:
+            proxy.forward("POST", "/", {"Content-Length": "8"}, io.BytesIO(b"document"))
+    finally:
+        for running in (slow, working):
+            running.shutdown()
+            running.server_close()
+
+    assert error.value.status == 504
+    assert received == [b"document"]
+    assert [backend.healthy for backend in proxy.backends] == [True, True]
+    assert [backend.outstanding for backend in proxy.backends] == [0, 0]
+
+
+def test_office_proxy_relays_bodyless_responses_and_all_methods():
+    from http.client import HTTPConnection
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+
+        def do_DELETE(self):
+            self.send_response(204)
+            self.end_headers()
+
+        def do_OPTIONS(self):
+            self.send_response(200)
+            self.send_header("Allow", "GET, HEAD, POST, PUT, DELETE, OPTIONS")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            self.send_response(304)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    office = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=office.serve_forever, daemon=True).start()
+    server = entrypoint.start_office_proxy(
+        [f"http://127.0.0.1:{office.server_address[1]}/"], bind="127.0.0.1", port=0
+    )
+    try:
+        # One keep-alive connection: a stray chunk terminator would corrupt the next response.
+        connection = HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        responses = []
+        for method in ("DELETE", "GET", "HEAD", "OPTIONS", "DELETE"):
+            connection.request(method, "/document")
+            response = connection.getresponse()
+            responses.append((response.status, response.read(), response.getheader("Transfer-Encoding")))
+            if method == "HEAD":
+                assert response.getheader("Content-Length") == "5"
+            if method == "OPTIONS":
+                assert "DELETE" in response.getheader("Allow")
+        connection.close()
+    finally:
+        for running in (server, office):
+            running.shutdown()
+            running.server_close()
+
+    assert responses == [
+        (204, b"", None),
+        (304, b"", None),
+        (200, b"", None),
+        (200, b"", None),
+        (204, b"", None),
+    ]
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_follow_log_file_survives_rotation_and_truncation(tmp_path, capsys):
+    log_path = tmp_path / "service.log"
+    log_path.write_text("first\n")
+    seen = []
+    stop_event = threading.Event()
+    follower = threading.Thread(
+        target=entrypoint.follow_log_file,
+        args=(str(log_path),),
+        kwargs={"line_handlers": [seen.append], "stop_event": stop_event},
+        daemon=True,
+    )
+    follower.start()
+    try:
+        assert _wait_until(lambda: seen == ["first\n"])
+
+        with open(log_path, "a") as handle:
+            handle.write("second\nthi")
+        assert _wait_until(lambda: seen[-1:] == ["second\n"])
+        with open(log_path, "a") as handle:
+            handle.write("rd\n")
+        assert _wait_until(lambda: seen[-1:] == ["third\n"])
+
+        log_path.rename(tmp_path / "service.log.1")
+        log_path.write_text("after rotation\n")
+        assert _wait_until(lambda: seen[-1:] == ["after rotation\n"])
+
+        log_path.write_text("")
+        with open(log_path, "a") as handle:
+            handle.write("x\n")
+        assert _wait_until(lambda: seen[-1:] == ["x\n"])
+    finally:
+        stop_event.set()
+        follower.join(timeout=5)
+
+    out = capsys.readouterr().out
+    assert "first\nsecond\nthird\n" in out
+    assert "after rotation\n" in out
+
+
+def test_wait_for_log_file_wakes_up_on_creation(tmp_path):
+    log_path = tmp_path / "late.log"
+    timer = threading.Timer(0.2, log_path.write_text, args=("ready\n",))
+    timer.start()
+    started = time.time()
+    try:
+        assert entrypoint.wait_for_log_file(str(log_path), timeout=10)
+    finally:
+        timer.cancel()
+    assert time.time() - started < 4
+
+
+def _make_archive(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def _serve_archive(monkeypatch, archive):
+    class ChunkedResponse:
+        status_code = 200
+
+        def iter_content(self, chunk_size=8192):
+            for offset in range(0, len(archive), 7):
+                yield archive[offset:offset + 7]
+
+    monkeypatch.setattr(entrypoint.requests, "get", lambda url, stream=True: ChunkedResponse())
+    monkeypatch.setattr(entrypoint.subprocess, "run", lambda *args, **kwargs: None)
+    monkeypatch.setattr(entrypoint, "_determine_serviceclient_version", lambda: "2025.1.0")
+
+
+def test_download_unpack_streams_and_verifies_checksum(monkeypatch, tmp_path, capsys):
+    archive = _make_archive({"censhare/censhare-Service-Client/serviceclient.sh": b"#!/bin/sh\n"})
+    _serve_archive(monkeypatch, archive)
+    extract_dir = tmp_path / "corpus"
+    (extract_dir / "censhare").mkdir(parents=True)
+    (extract_dir / "censhare" / "client-version.txt").write_text("old")
+    copy_path = tmp_path / "copy.tar.gz"
+
+    entrypoint.download_unpack(
+        "https://example.com/archive.tar.gz",
+        output_path=str(copy_path),
+        expected_sha256=hashlib.sha256(archive).hexdigest().upper(),
+        extract_dir=str(extract_dir),
+    )
+
+    assert (extract_dir / "censhare" / "censhare-Service-Client" / "serviceclient.sh").read_bytes() == b"#!/bin/sh\n"
+    assert (extract_dir / "censhare" / "client-version.txt").read_text() == "old"
+    assert [path.name for path in extract_dir.iterdir()] == ["censhare"]
+    assert copy_path.read_bytes() == archive
+    assert "Archive checksum verified." in capsys.readouterr().out
+
+
+def test_download_unpack_rejects_checksum_mismatch(monkeypatch, tmp_path):
+    archive = _make_archive({"censhare/payload.txt": b"data"})
+    _serve_archive(monkeypatch, archive)
+    extract_dir = tmp_path / "corpus"
+
+    with pytest.raises(SystemExit):
+        entrypoint.download_unpack(
+            "https://example.com/archive.tar.gz",
+            expected_sha256="0" * 64,
+            extract_dir=str(extract_dir),
+        )
+
+    assert list(extract_dir.iterdir()) == []
+
+
+@pytest.mark.parametrize("cut", [0.5, -10])
+def test_download_unpack_leaves_nothing_behind_for_a_truncated_archive(monkeypatch, tmp_path, cut):
+    archive = _make_archive({
+        "censhare/censhare-Service-Client/serviceclient.sh": b"#!/bin/sh\n",
+        "censhare/censhare-Service-Client/lib/client.jar": os.urandom(100000),
+    })
+    # Cut mid-member, or only the gzip trailer after the tar end-of-archive block.
+    _serve_archive(monkeypatch, archive[:int(len(archive) * cut)] if cut > 0 else archive[:cut])
+    extract_dir = tmp_path / "corpus"
+
+    with pytest.raises(SystemExit):
+        entrypoint.download_unpack("https://example.com/archive.tar.gz", extract_dir=str(extract_dir))
+
+    assert list(extract_dir.iterdir()) == []
+
+
+def test_install_service_client_reuses_cached_archive(monkeypatch, tmp_path):
+    archive = _make_archive({"censhare/censhare-Service-Client/serviceclient.sh": b"#!/bin/sh\n"})
+    _serve_archive(monkeypatch, archive)
+    cache_dir = tmp_path / "cache"
+
+    first_install = tmp_path / "first"
+    entrypoint.install_service_client(
+        "https://example.com/a.tar.gz", "2025.1.0", cache_dir=str(cache_dir), extract_dir=str(first_install)
+    )
+    digest = hashlib.sha256(archive).hexdigest()
+    assert (cache_dir / "archives" / f"sha256-{digest}.tar.gz").read_bytes() == archive
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("cache hit must not download")
+
+    monkeypatch.setattr(entrypoint.requests, "get", no_network)
+    second_install = tmp_path / "second"
+    entrypoint.install_service_client(
+        "https://example.com/a.tar.gz", "2025.1.0", cache_dir=str(cache_dir), extract_dir=str(second_install)
+    )
+
+    assert (second_install / "censhare" / "censhare-Service-Client" / "serviceclient.sh").exists()
+
+
+def test_download_unpack_assigns_corpus_ownership_without_chown(monkeypatch, tmp_path):
+    archive = _make_archive({"censhare/censhare-Service-Client/serviceclient.sh": b"#!/bin/sh\n"})
+    _serve_archive(monkeypatch, archive)
+    owners = []
+    monkeypatch.setattr(entrypoint, "_resolve_corpus_owner", lambda: (4242, 4343))
+    monkeypatch.setattr(entrypoint.os, "geteuid", lambda: 0)
+    monkeypatch.setattr(entrypoint.os, "lchown", lambda path, uid, gid: owners.append((path, uid, gid)))
+
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError("ownership must not be fixed with chown -R")
+
+    monkeypatch.setattr(entrypoint.subprocess, "run", no_subprocess)
+    members = []
+    original_open = entrypoint.tarfile.open
+
+    def recording_open(*args, **kwargs):
+        tar = original_open(*args, **kwargs)
+        original_extractall = tar.extractall
+
+        def extractall(path, filter=None, numeric_owner=False):
+            def record(member, dest):
+                member = filter(member, dest)
+                members.append((member.name, member.uid, member.gid))
+                return member.replace(uid=0, gid=0)  # keep the test runnable without root
+
+            return original_extractall(path, filter=record, numeric_owner=numeric_owner)
+
+        tar.extractall = extractall
+        return tar
+
+    monkeypatch.setattr(entrypoint.tarfile, "open", recording_open)
+    extract_dir = tmp_path / "corpus"
+    extract_dir.mkdir()
+    (extract_dir / "unrelated").mkdir()
+
+    entrypoint.download_unpack("https://example.com/archive.tar.gz", extract_dir=str(extract_dir))
+
+    assert members and all(uid == 4242 and gid == 4343 for _, uid, gid in members)
+    # Only the extraction directory itself is fixed up; the archive's entries were created with the right owner.
+    assert [path for path, _, _ in owners] == [str(extract_dir)]
+
+
+def test_fix_ownership_only_touches_mismatched_entries(monkeypatch, tmp_path):
+    (tmp_path / "tree" / "nested").mkdir(parents=True)
+    (tmp_path / "tree" / "nested" / "file.txt").write_text("x")
+    (tmp_path / "tree" / "link").symlink_to(tmp_path / "outside")
+    uid, gid = entrypoint.os.getuid(), entrypoint.os.getgid()
+    changed = []
+    monkeypatch.setattr(entrypoint.os, "lchown", lambda path, u, g: changed.append(path))
+
+    assert entrypoint.fix_ownership([str(tmp_path / "tree")], uid, gid) == 0
+    assert changed == []
+
+    count = entrypoint.fix_ownership([str(tmp_path / "tree")], uid + 1, gid, max_workers=2)
+    assert count == 4
+    assert sorted(changed) == sorted(
+        str(path) for path in [
+            tmp_path / "tree",
+            tmp_path / "tree" / "nested",
+            tmp_path / "tree" / "nested" / "file.txt",
+            tmp_path / "tree" / "link",
+        ]
+    )
+
+
+def test_evict_cache_entries_removes_least_recently_used(tmp_path):
+    for index, name in enumerate(["old", "middle", "new"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        entrypoint.os.utime(path, (1000 + index, 1000 + index))
+
+    entrypoint._evict_cache_entries(str(tmp_path), max_bytes=200)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["middle", "new"]
+
+    entrypoint._evict_cache_entries(str(tmp_path), max_bytes=100, keep={str(tmp_path / "middle")})
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["middle"]
+
+
+def test_parse_size_accepts_binary_suffixes():
+    assert entrypoint._parse_size("2GiB", 0) == 2 * entrypoint.GIB
+    assert entrypoint._parse_size("512M", 0) == 512 * entrypoint.MIB
+    assert entrypoint._parse_size("1024", 0) == 1024
+    assert entrypoint._parse_size("lots", 7) == 7
+
+
+def test_read_jdk_release_major(tmp_path):
+    (tmp_path / "release").write_text('IMPLEMENTOR="Amazon.com Inc."\nJAVA_VERSION="21.0.4"\n')
+    assert entrypoint.read_jdk_release_major(str(tmp_path)) == 21
+
+    (tmp_path / "release").write_text('JAVA_VERSION="1.8.0_412"\n')
+    assert entrypoint.read_jdk_release_major(str(tmp_path)) == 8
+
+    assert entrypoint.read_jdk_release_major(str(tmp_path / "missing")) is None
+
+
+def test_provision_cached_corretto_downloads_once(monkeypatch, tmp_path):
+    archive = _make_archive({
+        "amazon-corretto-21.0.4.7.1-linux-x64/release": b'JAVA_VERSION="21.0.4"\n',
+        "amazon-corretto-21.0.4.7.1-linux-x64/bin/java": b"#!/bin/sh\n",
+    })
+    requested = []
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, url):
+            self.text = hashlib.sha256(archive).hexdigest() + "\n"
+            requested.append(url)
+
+        def iter_content(self, chunk_size=8192):
+            yield archive
+
+    monkeypatch.delenv("JDK_SHA256", raising=False)
+    monkeypatch.setattr(entrypoint.requests, "get", lambda url, **kwargs: Response(url))
+    cache_dir = tmp_path / "jdk-cache"
+
+    java_home = entrypoint.provision_cached_corretto(21, "x64", str(cache_dir))
+
+    assert java_home == str(cache_dir / "corretto-21-x64")
+    assert (cache_dir / "corretto-21-x64" / "bin" / "java").exists()
+    assert any("latest_sha256" in url for url in requested)
+
+    requested.clear()
+    assert entrypoint.provision_cached_corretto(21, "x64", str(cache_dir)) == java_home
+    assert requested == []
+
+
+def test_provision_cached_corretto_rechecks_a_checksum_that_moved_during_download(monkeypatch, tmp_path):
+    archive = _make_archive({"amazon-corretto-21.0.5.11.1-linux-x64/release": b'JAVA_VERSION="21.0.5"\n'})
+    # The first checksum belongs to the previous release, the second to the downloaded one.
+    checksums = ["0" * 64, hashlib.sha256(archive).hexdigest()]
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, url):
+            self.text = checksums.pop(0) if "latest_sha256" in url else ""
+
+        def iter_content(self, chunk_size=8192):
+            yield archive
+
+    monkeypatch.delenv("JDK_SHA256", raising=False)
+    monkeypatch.setattr(entrypoint.requests, "get", lambda url, **kwargs: Response(url))
+
+    java_home = entrypoint.provision_cached_corretto(21, "x64", str(tmp_path))
+
+    assert entrypoint.read_jdk_release_major(java_home) == 21
+    assert checksums == []
+
+
+def test_provision_cached_corretto_refuses_to_cache_without_a_checksum(monkeypatch, tmp_path):
+    monkeypatch.delenv("JDK_SHA256", raising=False)
+    monkeypatch.setattr(entrypoint, "_fetch_corretto_sha256", lambda jdk_major, arch: None)
+    monkeypatch.setattr(entrypoint.requests, "get", lambda url, **kwargs: pytest.fail("downloaded unverified JDK"))
+
+    with pytest.raises(entrypoint.JdkChecksumUnavailable):
+        entrypoint.provision_cached_corretto(21, "x64", str(tmp_path))
+    assert not (tmp_path / "corretto-21-x64").exists()
+
+
+def test_ensure_corretto_registers_a_cached_jdk_with_update_alternatives(monkeypatch, tmp_path):
+    java_home = tmp_path / "corretto-21-x64"
+    (java_home / "bin").mkdir(parents=True)
+    (java_home / "bin" / "java").write_text("#!/bin/sh\n")
+    (java_home / "bin" / "javac").write_text("#!/bin/sh\n")
+    commands = []
+    monkeypatch.setenv("JDK_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("PATH", os.environ.get("PATH", ""))
+    monkeypatch.delenv("JAVA_HOME", raising=False)
+    monkeypatch.delenv("JDK_HOME", raising=False)
+    monkeypatch.setattr(entrypoint.shutil, "which", lambda name: None)
+    monkeypatch.setattr(entrypoint.platform, "machine", lambda: "x86_64")
+    monkeypatch.setattr(entrypoint, "provision_cached_corretto", lambda major, arch, cache_dir: str(java_home))
+    monkeypatch.setattr(entrypoint.subprocess, "run", lambda command, **kwargs: commands.append(command))
+
+    entrypoint.ensure_corretto(21)
+
+    assert os.environ["JAVA_HOME"] == str(java_home)
+    for name in ("java", "javac"):
+        binary = str(java_home / "bin" / name)
+        install = ["update-alternatives", "--install", f"/usr/bin/{name}", name, binary, "1"]
+        select = ["update-alternatives", "--set", name, binary]
+        assert commands.index(install) < commands.index(select)
+
+
+def test_run_startup_tasks_respects_dependencies_and_overlaps_independent_steps():
+    events = []
+    both_started = threading.Barrier(2, timeout=5)
+
+    def independent(name):
+        def run(results):
+            events.append(f"start:{name}")
+            both_started.wait()
+            return name
+        return run
+
+    tasks = {
+        "a": (independent("a"), []),
+        "b": (independent("b"), []),
+        "c": (lambda results: events.append(f"c:{results['a']}+{results['b']}") or "c", ["a", "b"]),
+    }
+
+    results = entrypoint.run_startup_tasks(tasks, max_workers=4)
+
+    assert results == {"a": "a", "b": "b", "c": "c"}
+    assert events[-1] == "c:a+b"
+
+
+def test_run_startup_tasks_rejects_cycles_and_propagates_failures():
+    with pytest.raises(ValueError):
+        entrypoint.run_startup_tasks({"a": (lambda results: None, ["b"]), "b": (lambda results: None, ["a"])})
+
+    def fail(results):
+        raise RuntimeError("boom")
+
+    ran = []
+    with pytest.raises(RuntimeError, match="boom"):
+        entrypoint.run_startup_tasks(
+            {"fail": (fail, []), "after": (lambda results: ran.append(True), ["fail"])},
+            max_workers=1,
+        )
+    assert ran == []
+
+
+def test_handle_office_facility_reuses_cached_probe(monkeypatch):
+    calls = []
+
+    def fake_request(self, method, url, **kwargs):
+        calls.append(url)
+
+        class Response:
+            status = 200
+
+        return Response()
+
+    monkeypatch.setattr(entrypoint.urllib3.PoolManager, "request", fake_request)
+    entrypoint.probe_office_url.cache_clear()
+    url = "http://office.invalid/cool/convert-to/pdf"
+
+    assert entrypoint.probe_office_url(url, True) == (True, "")
+    facility = _facility_xml("office", enabled="true")
+    entrypoint.handle_office_facility(facility, url, validate_certs=True)
+
+    assert calls == [url]
+    assert facility.find(".//path[@key='@@OFFICE@@']").get("port") == url
+    entrypoint.probe_office_url.cache_clear()
+
+
+def test_handle_office_facility_stays_enabled_behind_the_office_proxy(monkeypatch):
+    proxy_url = "http://127.0.0.1:18080/"
+    monkeypatch.setattr(entrypoint, "_office_proxy_url", proxy_url)
+    monkeypatch.setattr(entrypoint, "probe_office_url", lambda url, validate_certs: (False, "all endpoints down"))
+
+    facility = _facility_xml("office", enabled="true")
+    entrypoint.handle_office_facility(facility, proxy_url)
+    assert facility.get("enabled") == "true"
+    assert facility.find(".//path[@key='@@OFFICE@@']").get("port") == proxy_url
+
+    facility = _facility_xml("office", enabled="true")
+    entrypoint.handle_office_facility(facility, "http://office.invalid/convert")
+    assert facility.get("enabled") == "false"
+
+
+def test_start_office_proxy_uses_a_free_port_when_its_port_is_taken():
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    taken = HTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    server = entrypoint.start_office_proxy(["http://office.invalid/"], bind="127.0.0.1", port=taken.server_address[1])
+    try:
+        assert server is not None
+        assert server.server_address[1] not in (0, taken.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        taken.server_close()
+
+
+def test_startup_timeline_records_phases_and_transferred_bytes(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(entrypoint, "_startup_spans", [])
+    timeline_path = tmp_path / "timeline.json"
+
+    with entrypoint.trace_phase("install_client"):
+        entrypoint.record_transfer_bytes(1024)
+        with entrypoint.trace_phase("unpack"):
+            entrypoint.record_transfer_bytes(10)
+    entrypoint.run_startup_tasks(
+        {"configure": (lambda results: entrypoint.record_transfer_bytes(5), [])},
+        max_workers=1,
+    )
+    entrypoint.record_transfer_bytes(99)  # outside any phase: ignored
+
+    timeline = entrypoint.emit_startup_timeline(str(timeline_path))
+
+    phases = {phase["name"]: phase for phase in timeline["phases"]}
+    assert phases["install_client"]["bytes_transferred"] == 1024
+    assert phases["unpack"]["parent"] == "install_client"
+    assert phases["unpack"]["bytes_transferred"] == 10
+    assert phases["configure"]["bytes_transferred"] == 5
+    assert all(phase["status"] == "ok" for phase in phases.values())
+    assert {"wall_seconds", "cpu_seconds", "child_cpu_seconds"} <= set(phases["configure"])
+    assert entrypoint.json.loads(timeline_path.read_text()) == timeline
+    assert "Startup timeline: " in capsys.readouterr().out
+
+
+def _fingerprint_env(**overrides):
+    env = {"SVC_HOST": "host1", "SVC_USER": "user1", "SVC_PASS": "secret", "PATH": "/usr/bin"}
+    env.update(overrides)
+    return env
+
+
+def test_compute_config_fingerprint_tracks_relevant_inputs(tmp_path):
+    (tmp_path / "serviceclient.sh").write_text("#!/bin/sh\n")
+    base = entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env())
+
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env(PATH="/bin")) == base
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env(SVC_INSTANCES="8")) != base
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env(FFMPEG_TIMEOUT="9")) != base
+    assert entrypoint.compute_config_fingerprint("2025.2.0", str(tmp_path), _fingerprint_env()) != base
+
+    (tmp_path / "serviceclient.sh").write_text("#!/bin/sh\n# patched\n")
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env()) != base
+
+
+def test_compute_config_fingerprint_keys_the_password_with_a_private_secret(tmp_path):
+    (tmp_path / "serviceclient.sh").write_text("#!/bin/sh\n")
+    base = entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env())
+    key_path = tmp_path / entrypoint.CONFIG_FINGERPRINT_KEY_FILE
+
+    assert key_path.stat().st_mode & 0o777 == 0o600
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env()) == base
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env(SVC_PASS="new")) != base
+
+    # Without the key, guessing the right password does not reproduce the stored fingerprint.
+    key_path.unlink()
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env()) != base
+
+
+def test_compute_config_fingerprint_changes_with_the_entrypoint(monkeypatch, tmp_path):
+    (tmp_path / "serviceclient.sh").write_text("#!/bin/sh\n")
+    renderer = tmp_path / "entrypoint.py"
+    renderer.write_text("# v1\n")
+    monkeypatch.setattr(entrypoint, "__file__", str(renderer))
+    base = entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env())
+
+    renderer.write_text("# v2\n")
+    assert entrypoint.compute_config_fingerprint("2025.1.0", str(tmp_path), _fingerprint_env()) != base
+
+
+def test_is_config_current_requires_matching_fingerprint_and_untouched_files(monkeypatch, tmp_path):
+    prefs_path = _write_minimal_preferences(tmp_path, "host1", "user1")
+    monkeypatch.delenv("OFFICE_URL", raising=False)
+    monkeypatch.delenv("FORCE_SERVICECLIENT_SETUP", raising=False)
+
+    assert not entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+
+    entrypoint.store_config_fingerprint("abc", "host1", "user1", str(tmp_path))
+    assert entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+    assert not entrypoint.is_config_current("def", "host1", "user1", str(tmp_path))
+
+    monkeypatch.setenv("FORCE_SERVICECLIENT_SETUP", "true")
+    assert not entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+    monkeypatch.delenv("FORCE_SERVICECLIENT_SETUP")
+
+    monkeypatch.setenv("OFFICE_URL", "http://office.invalid/convert")
+    assert not entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+    monkeypatch.delenv("OFFICE_URL")
+
+    prefs_path.write_text(prefs_path.read_text().replace('instances="1"', 'instances="2"'))
+    assert not entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+
+
+def test_is_config_current_rechecks_the_office_url_behind_the_proxy(monkeypatch, tmp_path):
+    prefs_path = _write_minimal_preferences(tmp_path, "host1", "user1")
+    prefs_path.write_text(prefs_path.read_text().replace(
+        '<facility key="imagemagick"/>',
+        '<facility key="office"><path key="@@OFFICE@@" port="http://127.0.0.1:8090/"/></facility>',
+    ))
+    monkeypatch.delenv("FORCE_SERVICECLIENT_SETUP", raising=False)
+    monkeypatch.setenv("OFFICE_URL", "http://127.0.0.1:8090/")
+    entrypoint.store_config_fingerprint("abc", "host1", "user1", str(tmp_path))
+    assert entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+
+    # The proxy fell back to a free port, which the fingerprint does not see.
+    monkeypatch.setenv("OFFICE_URL", "http://127.0.0.1:41234/")
+    assert not entrypoint.is_config_current("abc", "host1", "user1", str(tmp_path))
+
+
+def test_sync_icc_profiles_copies_only_changes_and_prunes(tmp_path):
+    build_dir = tmp_path / "build"
+    mounted_dir = tmp_path / "mounted"
+    target_dir = tmp_path / "target"
+    build_dir.mkdir()
+    mounted_dir.mkdir()
+    (build_dir / "a.icc").write_bytes(b"build-a")
+    (build_dir / "b.icc").write_bytes(b"build-b")
+    (mounted_dir / "b.icc").write_bytes(b"mounted-b")
+
+    summary = entrypoint.sync_icc_profiles([str(build_dir), str(mounted_dir)], str(target_dir))
+    assert summary == {"copied": 2, "unchanged": 0, "pruned": 0}
+    assert (target_dir / "b.icc").read_bytes() == b"mounted-b"
+
+    summary = entrypoint.sync_icc_profiles([str(build_dir), str(mounted_dir)], str(target_dir))
+    assert summary == {"copied": 0, "unchanged": 2, "pruned": 0}
+
+    (mounted_dir / "b.icc").unlink()
+    summary = entrypoint.sync_icc_profiles([str(build_dir), str(mounted_dir)], str(target_dir), prune=True)
+    assert summary == {"copied": 1, "unchanged": 1, "pruned": 0}
+    assert (target_dir / "b.icc").read_bytes() == b"build-b"
+
+    (build_dir / "a.icc").unlink()
+    summary = entrypoint.sync_icc_profiles([str(build_dir), str(mounted_dir)], str(target_dir), prune=True)
+    assert summary == {"copied": 0, "unchanged": 1, "pruned": 1}
+    assert not (target_dir / "a.icc").exists()
+
+
+def test_sync_icc_profiles_detects_same_size_changes_with_hash(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    profile = source_dir / "p.icc"
+    profile.write_bytes(b"aaaa")
+    entrypoint.os.utime(profile, (1000, 1000))
+    target_dir = tmp_path / "target"
+    entrypoint.sync_icc_profiles([str(source_dir)], str(target_dir), verify_hash=True)
+
+    # Rewrite with identical size and mtime, as some network filesystems report.
+    profile.unlink()
+    profile.write_bytes(b"bbbb")
+    entrypoint.os.utime(profile, (1000, 1000))
+
+    assert entrypoint.sync_icc_profiles([str(source_dir)], str(target_dir))["copied"] == 0
+    assert entrypoint.sync_icc_profiles([str(source_dir)], str(target_dir), verify_hash=True)["copied"] == 1
+    assert (target_dir / "p.icc").read_bytes() == b"bbbb"
@@ -0,0 +1,40 @@
+import pytest
+
+import exiftool_client
+
+
+def test_daemon_args_resolves_relative_files_and_rejects_direct_only_calls(tmp_path):
+    (tmp_path / "in.jpg").write_bytes(b"jpeg")
+
+    assert exiftool_client.daemon_args(["-j", "in.jpg"], str(tmp_path)) == ["-j", str(tmp_path / "in.jpg")]
+    assert exiftool_client.daemon_args(["-o", "out.xmp", "-Title=x", "in.jpg"], str(tmp_path)) == [
+        "-o", str(tmp_path / "out.xmp"), "-Title=x", str(tmp_path / "in.jpg"),
+    ]
+    assert exiftool_client.daemon_args(["-tagsFromFile", "in.jpg", "/abs.jpg"], str(tmp_path)) == [
+        "-tagsFromFile", str(tmp_path / "in.jpg"), "/abs.jpg",
+    ]
+    assert exiftool_client.daemon_args(["-csv=meta.csv", "-ThumbnailImage<=in.jpg", "/abs.jpg"], str(tmp_path)) == [
+        f"-csv={tmp_path / 'meta.csv'}", f"-ThumbnailImage<={tmp_path / 'in.jpg'}", "/abs.jpg",
+    ]
+    # Tag values and text option values that happen to match a file stay as given.
+    assert exiftool_client.daemon_args(["-Title=in.jpg", "-d", "in.jpg", "-o", "%d%f.xmp", "/abs.jpg"], str(tmp_path)) == [
+        "-Title=in.jpg", "-d", "in.jpg", "-o", "%d%f.xmp", "/abs.jpg",
+    ]
+    assert exiftool_client.daemon_args(["-j", "-"], str(tmp_path)) is None
+    assert exiftool_client.daemon_args(["-config", "my.cfg", "in.jpg"], str(tmp_path)) is None
+    assert exiftool_client.daemon_args(["-Comment=two\nlines", "in.jpg"], str(tmp_path)) is None
+
+
+def test_main_runs_exiftool_directly_when_daemon_is_down(monkeypatch, tmp_path):
+    monkeypatch.setenv("EXIFTOOL_DAEMON_SOCKET", str(tmp_path / "missing.sock"))
+    calls = []
+
+    def fake_execv(path, argv):
+        calls.append((path, argv))
+        raise SystemExit(0)
+
+    monkeypatch.setattr(exiftool_client.os, "execv", fake_execv)
+    with pytest.raises(SystemExit):
+        exiftool_client.main(["exiftool_client.py", "-ver"])
+
+    assert calls == [(exiftool_client.EXIFTOOL_BINARY, [exiftool_client.EXIFTOOL_BINARY, "-ver"])]
@@ -0,0 +1,337 @@
+import contextlib
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+
+import pytest
+
+import facility_wrapper
+
+
+def _fake_tool(tmp_path, name):
+    """A stand-in for a facility binary that copies its first input to the last argument."""
+    counter = tmp_path / f"{name}.calls"
+    tool = tmp_path / "bin" / name
+    tool.parent.mkdir(exist_ok=True)
+    tool.write_text(
+        f"#!{sys.executable}\n"
+        "import shutil, sys\n"
+        f"open({str(counter)!r}, 'a').write('x')\n"
+        "shutil.copyfile(sys.argv[1], sys.argv[-1])\n"
+        "print('converted')\n"
+    )
+    tool.chmod(0o755)
+    return str(tool), counter
+
+
+class _Stdout:
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+
+@pytest.mark.parametrize(
+    "binary, args, expected",
+    [
+        ("/usr/local/bin/magick", ["in.jpg", "-resize", "50%", "out.png"], [(3, "")]),
+        ("/usr/local/bin/magick", ["identify", "in.jpg"], []),
+        ("/usr/local/bin/gs", ["-dBATCH", "-sOutputFile=out.png", "in.pdf"], [(1, "-sOutputFile=")]),
+        ("/usr/local/bin/gs", ["-dBATCH", "-sOutputFile=out-%d.png", "in.pdf"], None),
+        ("/usr/local/bin/ffmpeg", ["-y", "-i", "in.mp4", "-c:v", "libx264", "out.mp4"], [(5, "")]),
+        ("/usr/local/bin/ffmpeg", ["-i", "in.mp4", "a.mp4", "b.mp4"], None),
+        ("/usr/local/bin/pngquant", ["--output", "out.png", "256", "in.png"], [(1, "")]),
+        ("/usr/local/bin/pngquant", ["256", "in.png"], None),
+        ("/usr/local/bin/exiftool", ["-j", "in.jpg"], []),
+        ("/usr/local/bin/exiftool", ["-Title=x", "in.jpg"], None),
+        ("/usr/local/bin/wkhtmltoimage", ["https://example.com", "out.png"], None),
+        ("/usr/local/bin/wkhtmltoimage", ["page.html", "out.png"], None),
+        ("/usr/local/bin/magick", ["in.jpg", "-write", "side.png", "out.png"], None),
+        ("/usr/local/bin/magick", ["in.jpg", "+write", "mpr:copy", "out.png"], None),
+        ("/usr/local/bin/magick", ["in.gif", "frame-%03d.png"], None),
+        ("/usr/local/bin/magick", ["@files.txt", "out.pdf"], None),
+        ("/usr/local/bin/magick", ["label:@caption.txt", "out.png"], None),
+        ("/usr/local/bin/ffmpeg", ["-i", "img%03d.png", "out.mp4"], None),
+        ("/usr/local/bin/ffmpeg", ["-pattern_type", "glob", "-i", "img*.png", "out.mp4"], None),
+    ],
+)
+def test_rendition_outputs_only_accepts_safe_invocations(binary, args, expected):
+    assert facility_wrapper.rendition_outputs(binary, args) == expected
+
+
+def test_rendition_outputs_bypasses_wildcards_that_match_files(monkeypatch, tmp_path):
+    (tmp_path / "a.png").write_bytes(b"a")
+    (tmp_path / "b.png").write_bytes(b"b")
+    monkeypatch.chdir(tmp_path)
+
+    assert facility_wrapper.rendition_outputs("/usr/local/bin/magick", ["*.png", "out.pdf"]) is None
+    assert facility_wrapper.rendition_outputs("/usr/local/bin/magick", ["a.png", "-fx", "u*2", "out.png"]) == [(3, "")]
+
+
+def test_run_cached_does_not_store_an_output_the_tool_did_not_write(monkeypatch, tmp_path):
+    tool = tmp_path / "magick"
+    # Writes numbered frames, as ImageMagick does for multi-frame input.
+    tool.write_text(f"#!{sys.executable}\nimport sys\nopen(sys.argv[-1][:-4] + '-0.png', 'w').write('frame')\n")
+    tool.chmod(0o755)
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"))
+    source = tmp_path / "in.gif"
+    source.write_bytes(b"frames")
+    stale = tmp_path / "out.png"
+    stale.write_bytes(b"stale")
+    monkeypatch.setattr(facility_wrapper.sys, "stdout", _Stdout())
+
+    assert facility_wrapper.run_cached(str(tool), [str(source), str(stale)], cache)["cache"] == "miss"
+    assert os.listdir(tmp_path / "cache" / "entries") == []
+
+
+def test_run_cached_serves_repeated_renditions_from_cache(monkeypatch, tmp_path):
+    tool, counter = _fake_tool(tmp_path, "magick")
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"))
+    source = tmp_path / "in.jpg"
+    source.write_bytes(b"pixels")
+    monkeypatch.setattr(facility_wrapper.sys, "stdout", _Stdout())
+
+    for name in ("first.png", "second.png"):
+        assert facility_wrapper.run_cached(tool, [str(source), "-resize", "50%", str(tmp_path / name)], cache)["returncode"] == 0
+        assert (tmp_path / name).read_bytes() == b"pixels"
+    assert counter.read_text() == "x"
+    assert facility_wrapper.sys.stdout.buffer.getvalue() == b"converted\nconverted\n"
+
+    # Same path, new content: the key follows the content, not the file name.
+    source.write_bytes(b"other pixels")
+    os.utime(source, ns=(1, 1))
+    assert facility_wrapper.run_cached(tool, [str(source), "-resize", "50%", str(tmp_path / "third.png")], cache)["returncode"] == 0
+    assert (tmp_path / "third.png").read_bytes() == b"other pixels"
+    assert counter.read_text() == "xx"
+    assert os.listdir(tmp_path / "cache" / "locks") == []
+
+
+def test_run_cached_queues_for_admission_without_holding_the_cache_lock(monkeypatch, tmp_path):
+    tool, counter = _fake_tool(tmp_path, "magick")
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"))
+    source = tmp_path / "in.jpg"
+    source.write_bytes(b"pixels")
+    monkeypatch.setattr(facility_wrapper.sys, "stdout", _Stdout())
+    admitted = []
+
+    class Admission:
+        @contextlib.contextmanager
+        def admit(self, binary, args):
+            admitted.append(os.listdir(tmp_path / "cache" / "locks"))
+            yield 1.5
+
+    args = [str(source), "-resize", "50%", str(tmp_path / "out.png")]
+    assert facility_wrapper.run_cached(tool, args, cache, Admission())["queued_seconds"] == 1.5
+    # A hit is served without queueing.
+    assert "queued_seconds" not in facility_wrapper.run_cached(tool, args, cache, Admission())
+    assert admitted == [[]]
+    assert counter.read_text() == "x"
+
+
+def test_rendition_cache_lock_retries_when_the_lock_file_was_replaced(monkeypatch, tmp_path):
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"))
+    lock_path = tmp_path / "cache" / "locks" / "ab"
+    real_flock = facility_wrapper.fcntl.flock
+    calls = []
+
+    def flock(fd, operation):
+        # The first holder releases and removes the file while we wait.
+        if not calls:
+            os.unlink(lock_path)
+        calls.append(operation)
+        real_flock(fd, operation)
+
+    monkeypatch.setattr(facility_wrapper.fcntl, "flock", flock)
+    with cache.lock("ab"):
+        assert lock_path.exists()
+    assert len(calls) == 2
+    assert not lock_path.exists()
+
+
+def test_rendition_cache_evicts_least_recently_used_entries(tmp_path):
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"), max_bytes=300)
+    for index, key in enumerate(["aa", "bb", "cc"]):
+        output = tmp_path / f"{key}.png"
+        output.write_bytes(b"x" * 100)
+        cache.store(key, [str(output)], b"")
+        os.utime(tmp_path / "cache" / "entries" / key / "meta.json", (1000 + index, 1000 + index))
+    cache.evict()
+
+    assert sorted(os.listdir(tmp_path / "cache" / "entries")) == ["bb", "cc"]
+    assert cache.lookup("aa", [str(tmp_path / "restored.png")]) is None
+    assert cache.lookup("cc", [str(tmp_path / "restored.png")]) == b""
+    assert (tmp_path / "restored.png").read_bytes() == b"x" * 100
+
+
+def test_rendition_cache_tracks_its_size_without_walking_entries(monkeypatch, tmp_path):
+    cache = facility_wrapper.RenditionCache(str(tmp_path / "cache"), max_bytes=1000)
+    output = tmp_path / "out.png"
+    output.write_bytes(b"x" * 100)
+    cache.store("aa", [str(output)], b"")
+    sweeps = []
+    monkeypatch.setattr(cache, "evict", lambda keep=None: pytest.fail("evicted below the cap"))
+    monkeypatch.setattr(cache, "expire_hash_memos", lambda: sweeps.append(True))
+
+    cache.store("bb", [str(output)], b"abc")
+    cache.store("bb", [str(output)], b"")
+
+    index = json.loads((tmp_path / "cache" / "index.json").read_text())
+    assert index["bytes"] == 2 * (100 + len('{"outputs": 1}'))
+    assert sweeps == []
+
+
+def test_tune_args_disables_interpolation_for_ghostscript_previews(monkeypatch):
+    monkeypatch.setenv("GS_PREVIEW_NOINTERPOLATE", "true")
+    monkeypatch.delenv("GS_PREVIEW_MAX_RESOLUTION", raising=False)
+    preview = ["-sDEVICE=png16m", "-r96", "-sOutputFile=out.png", "in.pdf"]
+
+    assert facility_wrapper.tune_args("/usr/local/bin/gs", preview) == ["-dNOINTERPOLATE"] + preview
+    assert facility_wrapper.tune_args("/usr/local/bin/gs", ["-sDEVICE=png16m", "-r300", "in.pdf"])[0] == "-sDEVICE=png16m"
+    assert facility_wrapper.tune_args("/usr/local/bin/gs", ["-sDEVICE=pdfwrite", "in.pdf"])[0] == "-sDEVICE=pdfwrite"
+    assert facility_wrapper.tune_args("/usr/local/bin/magick", ["in.pdf", "out.png"]) == ["in.pdf", "out.png"]
+
+
+def test_tune_args_caps_ffmpeg_threads_per_input_and_output(monkeypatch):
+    monkeypatch.setenv("FFMPEG_THREADS", "3")
+    args = ["-y", "-i", "in.mov", "-c:v", "libx265", "-an", "out.mp4"]
+
+    assert facility_wrapper.tune_args("/usr/local/bin/ffmpeg", args) == [
+        "-filter_threads", "3", "-filter_complex_threads", "3",
+        "-y", "-threads", "3", "-i", "in.mov",
+        "-c:v", "libx265", "-an", "-threads", "3", "-x265-params", "pools=3", "out.mp4",
+    ]
+    explicit = ["-threads", "1", "-i", "in.webm", "-c:v", "libvpx-vp9", "-threads", "2", "out.webm"]
+    assert facility_wrapper.tune_args("/usr/local/bin/ffmpeg", explicit)[4:] == [
+        "-threads", "1", "-i", "in.webm", "-c:v", "libvpx-vp9", "-threads", "2", "-row-mt", "1", "out.webm",
+    ]
+    assert facility_wrapper.tune_args("/usr/local/bin/ffmpeg", ["-version"]) == ["-version"]
+
+
+def test_main_execs_the_tool_directly_without_features(monkeypatch):
+    monkeypatch.delenv("RENDITION_CACHE_DIR", raising=False)
+    monkeypatch.delenv("TOOL_INSTRUMENTATION_LOG", raising=False)
+    calls = []
+
+    def fake_execv(path, argv):
+        calls.append((path, argv))
+        raise SystemExit(0)
+
+    monkeypatch.setattr(facility_wrapper.os, "execv", fake_execv)
+    with pytest.raises(SystemExit):
+        facility_wrapper.main(["facility_wrapper.py", "/usr/local/bin/gs", "-v"])
+
+    assert calls == [("/usr/local/bin/gs", ["/usr/local/bin/gs", "-v"])]
+
+
+def test_main_records_redacted_invocations_and_rotates_the_log(monkeypatch, tmp_path):
+    tool, _ = _fake_tool(tmp_path, "gs")
+    source = tmp_path / "in.pdf"
+    source.write_bytes(b"%PDF")
+    log = tmp_path / "tools.jsonl"
+    monkeypatch.delenv("RENDITION_CACHE_DIR", raising=False)
+    monkeypatch.setenv("TOOL_INSTRUMENTATION_LOG", str(log))
+    monkeypatch.setenv("TOOL_INSTRUMENTATION_MAX_BYTES", "1")
+    monkeypatch.setenv("TOOL_INSTRUMENTATION_BACKUPS", "1")
+    monkeypatch.setattr(facility_wrapper.sys, "stdout", _Stdout())
+
+    for _ in range(2):
+        args = [str(source), "-sPDFPassword=hunter2", str(tmp_path / "out.png")]
+        assert facility_wrapper.main(["facility_wrapper.py", tool] + args) == 0
+
+    assert not log.exists()
+    record = json.loads((tmp_path / "tools.jsonl.1").read_text())
+    assert record["tool"] == "gs"
+    assert record["argv"][2] == "-sPDFPassword=***"
+    assert record["exit_code"] == 0
+    assert record["duration_seconds"] > 0
+    assert record["max_rss_bytes"] > 0
+    assert "cache" not in record
+
+
+def test_admission_controller_queues_jobs_beyond_the_budget(tmp_path):
+    image = tmp_path / "in.png"
+    image.write_bytes(b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 4000, 3000))
+    controller = facility_wrapper.AdmissionController(str(tmp_path / "admission"), slots=4, timeout=0)
+    magick_args = [str(image), "-resize", "50%", str(tmp_path / "out.jpg")]
+
+    # 4000x3000 pixels at 16 bytes each need 1 of the 256MiB slots, below the magick weight of 2.
+    assert controller.weight("/usr/local/bin/magick", magick_args) == 2
+    assert controller.weight("/usr/local/bin/gs", ["-r600", "-sDEVICE=png16m", "in.pdf"]) == 2
+    assert controller.weight("/usr/local/bin/exiftool", ["-j", str(image)]) == 0
+
+    with controller._job_lock() as waiter, controller.admit("/usr/local/bin/magick", magick_args) as queued:
+        assert queued < 1
+        # A worker that is still alive already waits for three slots; a new job may not overtake it.
+        with controller._state() as state:
+            state["waiting"][waiter] = [state["next_ticket"], 3]
+            state["next_ticket"] += 1
+        with pytest.raises(facility_wrapper.AdmissionTimeout):
+            with controller.admit("/usr/local/bin/pngquant", ["--output", "out.png", "256", str(image)]):
+                pass
+
+        with controller._state() as state:
+            assert list(state["waiting"]) == [waiter]
+
+    # Once the waiter's lock is gone its entry is dropped.
+    with controller._state() as state:
+        assert state["running"] == {}
+        assert state["waiting"] == {}
+
+
+def test_admission_controller_frees_slots_of_killed_workers(tmp_path):
+    controller = facility_wrapper.AdmissionController(str(tmp_path / "admission"), slots=2, timeout=5)
+    ready = tmp_path / "ready"
+    worker = subprocess.Popen([sys.executable, "-c", (
+        "import pathlib, sys, time, facility_wrapper\n"
+        f"controller = facility_wrapper.AdmissionController({str(tmp_path / 'admission')!r}, slots=2)\n"
+        "with controller.admit('/usr/local/bin/gs', ['in.pdf']):\n"
+        f"    pathlib.Path({str(ready)!r}).touch()\n"
+        "    time.sleep(60)\n"
+    )], cwd=os.path.dirname(facility_wrapper.__file__))
+    try:
+        deadline = time.monotonic() + 10
+        while not ready.exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with controller._state() as state:
+            assert list(state["running"].values()) == [2]
+        # The entry is not keyed by PID, so a reused or foreign PID cannot keep it alive.
+        assert str(worker.pid) not in state["running"]
+    finally:
+        worker.kill()
+        worker.wait()
+
+    with controller.admit("/usr/local/bin/gs", ["in.pdf"]) as queued:
+        assert queued < 1
+    assert os.listdir(tmp_path / "admission" / "jobs") == []
+
+
+def test_run_tool_child_dies_with_a_killed_wrapper(tmp_path):
+    tool = tmp_path / "tool"
+    pid_file = tmp_path / "tool.pid"
+    tool.write_text(f"#!/bin/sh\necho $$ > {pid_file}\nexec sleep 60\n")
+    tool.chmod(0o755)
+    wrapper = subprocess.Popen([sys.executable, "-c", (
+        f"import facility_wrapper; facility_wrapper.run_tool({str(tool)!r}, [])"
+    )], cwd=os.path.dirname(facility_wrapper.__file__))
+    try:
+        deadline = time.monotonic() + 10
+        while not (pid_file.exists() and pid_file.read_text().strip()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        tool_pid = int(pid_file.read_text())
+    finally:
+        wrapper.kill()
+        wrapper.wait()
+
+    def running(pid):
+        try:
+            with open(f"/proc/{pid}/stat") as handle:
+                return handle.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except FileNotFoundError:
+            return False
+
+    deadline = time.monotonic() + 10
+    while running(tool_pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not running(tool_pid)
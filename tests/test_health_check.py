@@ -1,3 +1,5 @@
+import ipaddress
+import socket
 import socketserver
 import threading
 import time
@@ -39,8 +41,13 @@ def test_check_rmi_port_open(monkeypatch):
 
 
 def test_health_check_includes_rmi_port(monkeypatch):
+    monkeypatch.setattr(health_check, "query_health_server", lambda socket_path: None)
     monkeypatch.setattr(health_check, "check_java_process", lambda: True)
-    monkeypatch.setattr(health_check, "check_log_file", lambda *args, **kwargs: True)
+    monkeypatch.setattr(
+        health_check,
+        "check_log_patterns",
+        lambda log_path, patterns, state_path=None: {name: True for name in patterns},
+    )
     monkeypatch.setattr(health_check, "check_tcp_connection", lambda: True)
     monkeypatch.setattr(health_check, "resolve_rmi_port", lambda: 12345)
     monkeypatch.setattr(health_check, "check_rmi_port_open", lambda port: port == 12345)
@@ -49,3 +56,160 @@ def test_health_check_includes_rmi_port(monkeypatch):
 
     monkeypatch.setattr(health_check, "check_rmi_port_open", lambda port: False)
     assert health_check.health_check() == 1
+
+
+def _scan_patterns():
+    return {
+        "login": health_check.login_pattern,
+        "service_registration": health_check.service_registration_pattern,
+    }
+
+
+def test_scan_log_file_resumes_from_saved_offset(tmp_path):
+    log_path = tmp_path / "service.log"
+    log_path.write_text("INFO   : LoginAction: ServiceClientLoginAction: client token: abc\npartial")
+    state = {}
+
+    matched = health_check.scan_log_file(str(log_path), _scan_patterns(), state)
+    assert matched == {"login": True, "service_registration": False}
+    # The unterminated trailing line is not consumed yet.
+    assert state["offset"] == log_path.read_bytes().index(b"partial")
+
+    with open(log_path, "a") as handle:
+        handle.write(" line\nINFO   : LoginAction: RMIProcessClient: created new RMIProcessClient 'ClientCLIService'\n")
+
+    matched = health_check.scan_log_file(str(log_path), _scan_patterns(), state)
+    assert matched == {"login": True, "service_registration": True}
+    assert state["offset"] == log_path.stat().st_size
+
+
+def test_scan_log_file_restarts_after_truncation_and_rotation(tmp_path):
+    log_path = tmp_path / "service.log"
+    log_path.write_text("INFO   : LoginAction: ServiceClientLoginAction: client token: abc\n")
+    state = {}
+    assert health_check.scan_log_file(str(log_path), _scan_patterns(), state)["login"]
+
+    log_path.write_text("")
+    assert not health_check.scan_log_file(str(log_path), _scan_patterns(), state)["login"]
+
+    rotated = tmp_path / "service.log.new"
+    rotated.write_text("INFO   : LoginAction: ServiceClientLoginAction: client token: def\n")
+    rotated.replace(log_path)
+    assert health_check.scan_log_file(str(log_path), _scan_patterns(), state)["login"]
+
+
+def test_check_log_patterns_persists_state(tmp_path):
+    log_path = tmp_path / "service.log"
+    log_path.write_text("INFO   : LoginAction: ServiceClientLoginAction: client token: abc\n")
+    state_path = tmp_path / "state.json"
+
+    assert health_check.check_log_patterns(str(log_path), _scan_patterns(), str(state_path))["login"]
+    saved = health_check.load_scan_state(str(state_path))
+    assert saved["matched"]["login"] is True
+    assert saved["offset"] == log_path.stat().st_size
+
+
+def test_find_service_client_pids_matches_service_client_jvm(tmp_path):
+    processes = {
+        "101": b"/usr/bin/java\0-cp\0/opt/corpus/censhare/censhare-Service-Client/lib/*\0com.censhare.ServiceClient\0",
+        "102": b"/usr/bin/java\0-jar\0other.jar\0",
+        "103": b"python3\0/usr/local/bin/entrypoint.py\0",
+    }
+    for pid, cmdline in processes.items():
+        (tmp_path / pid).mkdir()
+        (tmp_path / pid / "cmdline").write_bytes(cmdline)
+    (tmp_path / "self").mkdir()
+
+    assert health_check.find_service_client_pids(str(tmp_path)) == [101]
+
+
+def test_read_established_remote_addresses_parses_ipv4_and_ipv6(tmp_path):
+    header = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+    tcp = tmp_path / "tcp"
+    tcp.write_text(
+        header
+        + "   0: 0100007F:1F90 0A00000A:7782 01 00000000:00000000 00:00000000 00000000     0        0 1\n"
+        + "   1: 00000000:7796 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 2\n"
+    )
+    tcp6 = tmp_path / "tcp6"
+    tcp6.write_text(
+        header
+        + "   0: 00000000000000000000000001000000:1F90 0000000000000000FFFF00000B00000A:7782 01 "
+        "00000000:00000000 00:00000000 00000000     0        0 3\n"
+        + "   1: 00000000000000000000000001000000:1F90 B80D0120000000000000000001000000:7782 01 "
+        "00000000:00000000 00:00000000 00000000     0        0 4\n"
+    )
+
+    addresses = health_check.read_established_remote_addresses((str(tcp), str(tcp6)))
+
+    assert {str(address) for address in addresses} == {"10.0.0.10", "10.0.0.11", "2001:db8::1"}
+
+
+def test_check_tcp_connection_requires_connection_to_svc_host(monkeypatch):
+    monkeypatch.setattr(
+        health_check, "read_established_remote_addresses", lambda: {ipaddress.ip_address("10.0.0.10")}
+    )
+    monkeypatch.setenv("SVC_HOST", "censhare.example.com")
+
+    monkeypatch.setattr(
+        health_check, "resolve_service_host_addresses", lambda host: {ipaddress.ip_address("10.0.0.10")}
+    )
+    assert health_check.check_tcp_connection()
+
+    monkeypatch.setattr(
+        health_check, "resolve_service_host_addresses", lambda host: {ipaddress.ip_address("10.0.0.99")}
+    )
+    assert not health_check.check_tcp_connection()
+
+
+def test_check_tcp_connection_fails_when_svc_host_does_not_resolve(monkeypatch):
+    monkeypatch.setattr(
+        health_check, "read_established_remote_addresses", lambda: {ipaddress.ip_address("10.0.0.10")}
+    )
+    monkeypatch.setenv("SVC_HOST", "censhare.example.com")
+    monkeypatch.setattr(health_check, "resolve_service_host_addresses", lambda host: set())
+
+    assert not health_check.check_tcp_connection()
+
+
+def test_resolve_service_host_addresses_caches_lookups_for_the_ttl(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, port, proto=0):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, proto, "", ("10.0.0.10", 0))]
+
+    monkeypatch.setattr(health_check, "_resolved_hosts", {})
+    monkeypatch.setattr(health_check.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setenv("SVC_HOST_DNS_TTL", "60")
+
+    expected = {ipaddress.ip_address("10.0.0.10")}
+    assert health_check.resolve_service_host_addresses("censhare.example.com", now=0) == expected
+    assert health_check.resolve_service_host_addresses("censhare.example.com", now=59) == expected
+    assert lookups == ["censhare.example.com"]
+    assert health_check.resolve_service_host_addresses("censhare.example.com", now=60) == expected
+    assert len(lookups) == 2
+
+
+def test_health_check_uses_cached_verdict_within_ttl(monkeypatch, capsys):
+    def fail_if_probed():
+        raise AssertionError("cached verdict should be used")
+
+    monkeypatch.setenv("HEALTH_CHECK_TTL", "60")
+    monkeypatch.setattr(health_check, "evaluate_health", fail_if_probed)
+
+    monkeypatch.setattr(
+        health_check,
+        "query_health_server",
+        lambda socket_path: {"status": 0, "message": "Service is healthy.", "checked_at": time.time() - 5},
+    )
+    assert health_check.health_check() == 0
+    assert "checked 5s ago" in capsys.readouterr().out
+
+    monkeypatch.setattr(
+        health_check,
+        "query_health_server",
+        lambda socket_path: {"status": 0, "message": "Service is healthy.", "checked_at": time.time() - 120},
+    )
+    assert health_check.health_check() == 1
+    assert "stale" in capsys.readouterr().out